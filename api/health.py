@@ -1,8 +1,60 @@
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Depends, Response, status
+
+from database import HEALTH_PROBES, LOOP_MONITOR, XRAY_INSTANCE
+from provisioning import PROVISIONING
+from security import check_api_key
+
+import schemas
 
 
 router = APIRouter(prefix='/v1/health', tags=['Health'])
 
-@router.get('/', status_code=status.HTTP_418_IM_A_TEAPOT)
+@router.get('/', status_code=status.HTTP_418_IM_A_TEAPOT, response_model=schemas.Health)
 async def health():
-    pass
+    return schemas.Health(
+        xray={
+            name: node.breaker.snapshot()
+            for name, node in XRAY_INSTANCE.nodes.items()
+        },
+        provisioning=schemas.Provisioning.model_validate(PROVISIONING, from_attributes=True)
+    )
+
+@router.get('/live', status_code=status.HTTP_200_OK, response_model=schemas.Liveness)
+async def liveness(response: Response):
+    is_alive = HEALTH_PROBES.is_alive()
+
+    if not is_alive:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return schemas.Liveness(
+        is_alive=is_alive,
+        probe_age_seconds=HEALTH_PROBES.get_probe_age(),
+        last_cycle_age_seconds=HEALTH_PROBES.get_cycle_age()
+    )
+
+@router.get('/ready', status_code=status.HTTP_200_OK, response_model=schemas.Readiness)
+async def readiness(response: Response):
+    is_ready = HEALTH_PROBES.is_ready()
+
+    if not is_ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return schemas.Readiness(
+        is_ready=is_ready,
+        checked_date=HEALTH_PROBES.checked_date,
+        database=HEALTH_PROBES.database,
+        xray=HEALTH_PROBES.nodes,
+        last_cycle_date=HEALTH_PROBES.last_cycle_date,
+        last_cycle_age_seconds=HEALTH_PROBES.get_cycle_age(),
+        provisioning=schemas.Provisioning.model_validate(PROVISIONING, from_attributes=True)
+    )
+
+@router.get('/loop', status_code=status.HTTP_200_OK, response_model=schemas.LoopLag)
+async def loop_lag(_ = Depends(check_api_key)):
+    return schemas.LoopLag(
+        interval_ms=LOOP_MONITOR.interval * 1000,
+        threshold_ms=LOOP_MONITOR.threshold * 1000,
+        samples=len(LOOP_MONITOR.lags),
+        **LOOP_MONITOR.get_percentiles(),
+        stalls=LOOP_MONITOR.get_stalls()
+    )
@@ -0,0 +1,38 @@
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+from crud import history
+from database import get_session
+from security import check_api_key
+
+import schemas
+
+
+router = APIRouter(prefix='/v1/history', tags=['History'])
+
+@router.get('/{inbound_tag}', status_code=status.HTTP_200_OK, response_model=schemas.TrafficUsage)
+async def get_usage(
+    inbound_tag: str,
+    start: datetime = Query(),
+    end: datetime | None = Query(default=None),
+    email: str | None = Query(default=None),
+    session: AsyncSession = Depends(get_session),
+    _ = Depends(check_api_key)
+):
+    start = schemas.to_local(start)
+    end = schemas.to_local(end) if end else datetime.now()
+
+    if start >= end:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'start must be before end')
+
+    upload_traffic, download_traffic = await history.get_usage(session, inbound_tag, email, start, end)
+
+    return schemas.TrafficUsage(
+        inbound_tag=inbound_tag,
+        email=email,
+        start=start,
+        end=end,
+        upload_traffic=upload_traffic,
+        download_traffic=download_traffic
+    )
@@ -0,0 +1,42 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import PlainTextResponse
+
+from profiler import PROFILER
+from security import check_api_key
+
+import schemas
+
+
+router = APIRouter(prefix='/v1/profile', tags=['Profile'])
+
+def read_profile() -> schemas.ReadProfile:
+    return schemas.ReadProfile(
+        is_armed=PROFILER.is_armed,
+        target=PROFILER.target,
+        mode=PROFILER.mode,
+        runs_left=PROFILER.runs_left,
+        started_date=PROFILER.started_date,
+        finished_date=PROFILER.finished_date,
+        has_result=PROFILER.result is not None
+    )
+
+@router.post('/', status_code=status.HTTP_202_ACCEPTED, response_model=schemas.ReadProfile)
+async def arm_profile(profile: schemas.CreateProfile, _ = Depends(check_api_key)):
+    try:
+        PROFILER.arm(profile.target, profile.mode, profile.runs, profile.seconds)
+
+    except RuntimeError as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+
+    return read_profile()
+
+@router.get('/', status_code=status.HTTP_200_OK, response_model=schemas.ReadProfile)
+async def get_profile(_ = Depends(check_api_key)):
+    return read_profile()
+
+@router.get('/result', status_code=status.HTTP_200_OK, response_class=PlainTextResponse)
+async def get_profile_result(_ = Depends(check_api_key)):
+    if PROFILER.result is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Profile is not finished')
+
+    return PROFILER.result
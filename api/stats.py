@@ -1,9 +1,11 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Request, Response, status
 
 from schemas import XrayError
+from changes import CHANGES
 from crud.users import get_users
-from database import XRAY_INSTANCE, get_session
+from database import HEALTH_PROBES, XRAY_INSTANCE, get_session
+from etags import check_etag, make_etag
 from security import check_api_key
 
 import schemas
@@ -13,9 +15,14 @@ router = APIRouter(prefix='/v1/stats', tags=['Stats'])
 
 @router.get('/', status_code=status.HTTP_200_OK, response_model=schemas.ReadStats[schemas.Inbound])
 async def get_stats(
+    request: Request,
+    response: Response,
     session: AsyncSession = Depends(get_session),
     _ = Depends(check_api_key)
 ):
+    # inbound counters are read from Xray, they are considered fresh for one cycle
+    check_etag(request, response, make_etag('stats', HEALTH_PROBES.cycles, CHANGES.get_inbound_version(None)))
+
     result = []
     inbound_tags = []
 
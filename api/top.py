@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends, Query, status
+from typing import List
+
+from database import LEADERBOARDS
+from security import check_api_key
+
+import schemas
+
+
+router = APIRouter(prefix='/v1/top', tags=['Top'])
+
+@router.get('/', status_code=status.HTTP_200_OK, response_model=List[schemas.TopUser])
+async def get_top(
+    by: schemas.TopMetricEnum = Query(default=schemas.TopMetricEnum.traffic),
+    limit: int = Query(default=min(10, LEADERBOARDS.size), ge=1, le=LEADERBOARDS.size),
+    inbound_tag: str | None = Query(default=None),
+    _ = Depends(check_api_key)
+):
+    return LEADERBOARDS.get_top(by.value, inbound_tag, limit)
@@ -1,17 +1,47 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 
 from schemas import XrayError
-from database import XRAY_INSTANCE, get_session
-from crud import users
+from changes import CHANGES
+from etags import check_etag, make_etag
+from fast_json import FAST_JSON_RESPONSES, dump_users, get_user_columns
+from database import EXPIRY, RATE_TRACKER, WEBHOOKS, XRAY_CONFIG_SNAPSHOT, XRAY_INSTANCE, XRAY_OUTBOX, get_session
+from crud import operations, users
 from security import check_api_key
 from loki_logger import LOGGER
 
-import schemas
+import models, schemas
 
 
 router = APIRouter(prefix='/v1/users', tags=['Users'])
 
+# registered before POST /{inbound_tag}, which would take "batch" for a tag
+@router.post('/batch', status_code=status.HTTP_200_OK, response_model=schemas.ReadUsersBatch)
+async def get_users_batch(
+    batch: schemas.UserKeys,
+    session: AsyncSession = Depends(get_session),
+    _ = Depends(check_api_key)
+):
+    keys = list({(key.inbound_tag, key.email) for key in batch.users})
+    usersList = await users.get_users_by_keys(session, keys)
+
+    result = {}
+
+    for user in usersList:
+        result.setdefault(user.inbound_tag, {})[user.email] = schemas.ReadUser.model_validate(
+            user,
+            from_attributes=True
+        ).model_copy(update=RATE_TRACKER.get_rates(user.email))
+
+    return schemas.ReadUsersBatch(
+        users=result,
+        missing=[
+            schemas.UserKey(inbound_tag=inbound_tag, email=email)
+            for inbound_tag, email in keys
+            if email not in result.get(inbound_tag, {})
+        ]
+    )
+
 @router.post('/{inbound_tag}', status_code=status.HTTP_201_CREATED, response_model=schemas.ReadUser)
 async def create_user(
     inbound_tag: str,
@@ -24,7 +54,7 @@ async def create_user(
     if not user:
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    result = await XRAY_INSTANCE.add_user(
+    results = await XRAY_INSTANCE.add_user_to_nodes(
 		inbound_tag=user.inbound_tag,
 		email=user.email,
 		level=user.level,
@@ -33,10 +63,28 @@ async def create_user(
 		cipher_type=user.cipher_type,
 		uuid=user.uuid,
 		flow=user.flow,
+		node=user.node,
 	)
+    result = XRAY_INSTANCE.merge_errors(results) if results else XrayError(f'no node serves {inbound_tag}')
+
+    # nodes which accepted the user keep it, so the row stays and the outbox adds it to the others
+    if type(result) is XrayError and None in results.values():
+        await operations.enqueue_operation(session, inbound_tag, user.email, user.node, schemas.OperationEnum.add)
+        await session.commit()
+        XRAY_OUTBOX.schedule()
+
+        LOGGER.warning(
+            'CREATE USER PARTIAL',
+            extra={
+                'tags': {
+                    'error_msg': result.message,
+                    'email': user.email
+                }
+            }
+        )
 
-    if type(result) is XrayError:
-        await users.delete_user(session, inbound_tag, user.email)
+    elif type(result) is XrayError:
+        await users.delete_user(session, inbound_tag, user.email, tombstone=False)
 
         LOGGER.error(
             'CREATE USER ERROR',
@@ -51,16 +99,67 @@ async def create_user(
 
         raise HTTPException(status.HTTP_502_BAD_GATEWAY, result.message)
 
+    XRAY_CONFIG_SNAPSHOT.schedule()
+    EXPIRY.schedule(inbound_tag, user.email, user.expires_at)
+    WEBHOOKS.emit('user.created', inbound_tag, user.email, limit=user.limit, is_active=user.is_active)
+
     return user
 
+# registered before /{inbound_tag}, which would take "changes" for a tag
+@router.get('/changes', status_code=status.HTTP_200_OK, response_model=schemas.ReadChanges[schemas.ReadUser])
+async def get_changes(
+    since: int = Query(default=0, ge=0),
+    limit: int = Query(default=1000, ge=1, le=10000),
+    inbound_tag: str | None = Query(default=None),
+    session: AsyncSession = Depends(get_session),
+    _ = Depends(check_api_key)
+):
+    # versions of transactions which are still open are not returned yet
+    until = CHANGES.get_visible_version()
+    usersList, tombstones = await users.get_changes(session, since, until, inbound_tag, limit)
+
+    changes = sorted([*usersList, *tombstones], key=lambda change: change.version)[:limit]
+    has_more = len(usersList) == limit or len(tombstones) == limit
+
+    return schemas.ReadChanges(
+        users=[change for change in changes if isinstance(change, models.User)],
+        deleted=[
+            schemas.DeletedUser(
+                inbound_tag=change.inbound_tag,
+                email=change.email,
+                version=change.version,
+                deleted_date=change.deleted_date
+            )
+            for change in changes if isinstance(change, models.UserTombstone)
+        ],
+        cursor=changes[-1].version if has_more else max(until, since),
+        has_more=has_more
+    )
+
 @router.get('/{inbound_tag}', status_code=status.HTTP_200_OK, response_model=schemas.ReadUsers[schemas.ReadUser])
 async def get_users(
     inbound_tag: str,
+    request: Request,
+    response: Response,
     is_traffic_overage: bool | None = Query(default=None),
     is_active: bool | None = Query(default=None),
     session: AsyncSession = Depends(get_session),
     _ = Depends(check_api_key)
 ):
+    # every row change of the inbound moves its version
+    check_etag(request, response, make_etag('users', CHANGES.get_inbound_version(inbound_tag)))
+
+    if FAST_JSON_RESPONSES:
+        rows, total = await users.get_users(
+            session,
+            inbound_tag,
+            is_traffic_overage=is_traffic_overage,
+            is_active=is_active,
+            columns=get_user_columns()
+        )
+
+        return Response(dump_users(rows, total), media_type='application/json', headers={'ETag': response.headers['ETag']})
+
     usersList, total = await users.get_users(
         session,
         inbound_tag,
@@ -85,7 +184,9 @@ async def get_user(
     if total != 1:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
 
-    return usersList[0]
+    return schemas.ReadUser.model_validate(usersList[0], from_attributes=True).model_copy(
+        update=RATE_TRACKER.get_rates(email)
+    )
 
 @router.delete('/{inbound_tag}/{email}', status_code=status.HTTP_204_NO_CONTENT)
 async def remove_user(
@@ -94,10 +195,16 @@ async def remove_user(
     session: AsyncSession = Depends(get_session),
     _ = Depends(check_api_key)
 ):
-    if not await users.delete_user(session, inbound_tag, email):
+    user = await users.delete_user(session, inbound_tag, email)
+
+    if not user:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
 
-    result = await XRAY_INSTANCE.remove_user(inbound_tag, email)
+    XRAY_CONFIG_SNAPSHOT.schedule()
+    EXPIRY.schedule(inbound_tag, email, None)
+    WEBHOOKS.emit('user.deleted', inbound_tag, email)
+
+    result = await XRAY_INSTANCE.remove_user(inbound_tag, email, user.node)
 
     if type(result) is XrayError and "not found" not in result.message:
         LOGGER.error(
@@ -111,6 +218,11 @@ async def remove_user(
             exc_info=True,
         )
 
+        # the row is gone, only the outbox can finish the removal
+        await operations.enqueue_operation(session, inbound_tag, email, user.node, schemas.OperationEnum.remove)
+        await session.commit()
+        XRAY_OUTBOX.schedule()
+
         raise HTTPException(status.HTTP_502_BAD_GATEWAY, result.message)
 
 @router.patch('/{inbound_tag}/{email}', status_code=status.HTTP_204_NO_CONTENT)
@@ -127,4 +239,18 @@ async def update_user(
     if user_data.traffic and user_data.traffic == 0:
         user_data.traffic = -1
 
+    _, total = await users.get_users(session, inbound_tag, email)
+
+    if total != 1:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+
+    # null removes the expiry, which update_user would skip
+    if 'expires_at' in user_data.model_fields_set:
+        await users.set_expires_at(session, inbound_tag, email, user_data.expires_at)
+
     await users.update_user(session, inbound_tag, email, user_data)
+
+    if 'expires_at' in user_data.model_fields_set:
+        EXPIRY.schedule(inbound_tag, email, user_data.expires_at)
+
+    WEBHOOKS.emit('user.updated', inbound_tag, email, changes=user_data.model_dump(mode='json', exclude_unset=True))
@@ -0,0 +1,85 @@
+from typing import Dict, Iterable, Tuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class ChangeVersions:
+    """
+    Monotonic version stamped on every changed user row. A version is
+    visible only once every lower one is committed, so a reader never
+    skips the changes of a transaction which took its versions earlier
+    and committed later.
+    """
+
+    def __init__(self) -> None:
+        self.version = 0
+
+        # lowest version taken by every transaction which is still open
+        self.open: Dict[int, int] = {}
+
+        # last committed version of every inbound, the base one counts for all
+        self.base_version = 0
+        self.inbound_versions: Dict[str, int] = {}
+
+    def load(self, versions: Iterable[Tuple[str, int | None]]) -> None:
+        for inbound_tag, version in versions:
+            version = version or 0
+            self.version = max(self.version, version)
+            self.inbound_versions[inbound_tag] = max(self.inbound_versions.get(inbound_tag, 0), version)
+
+    def next(self, session, inbound_tag: str | None) -> int:
+        """
+        Take the next version for a change made in the transaction of the session
+        :param inbound_tag: None for a change which may touch every inbound
+        """
+        self.version += 1
+
+        info = session.info
+        info.setdefault('change_versions', {})[inbound_tag] = self.version
+
+        if 'change_version' not in info:
+            info['change_version'] = self.version
+            self.open[id(info)] = self.version
+
+        return self.version
+
+    def get_visible_version(self) -> int:
+        return min(self.open.values()) - 1 if self.open else self.version
+
+    def get_inbound_version(self, inbound_tag: str | None) -> int:
+        if inbound_tag is None:
+            return max(self.base_version, *self.inbound_versions.values(), 0)
+
+        return max(self.base_version, self.inbound_versions.get(inbound_tag, 0))
+
+    def release(self, session: Session, is_committed: bool) -> None:
+        info = session.info
+        versions = info.pop('change_versions', None)
+
+        if versions is None:
+            return
+
+        info.pop('change_version', None)
+        self.open.pop(id(info), None)
+
+        if not is_committed:
+            return
+
+        for inbound_tag, version in versions.items():
+            if inbound_tag is None:
+                self.base_version = max(self.base_version, version)
+            else:
+                self.inbound_versions[inbound_tag] = max(self.inbound_versions.get(inbound_tag, 0), version)
+
+CHANGES = ChangeVersions()
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session: Session) -> None:
+    CHANGES.release(session, is_committed=True)
+
+@event.listens_for(Session, 'after_transaction_end')
+def after_transaction_end(session: Session, transaction) -> None:
+    # rolled back or closed without a commit, the versions are skipped
+    if transaction.parent is None:
+        CHANGES.release(session, is_committed=False)
@@ -0,0 +1,69 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ZstdResponder(IdentityResponder):
+    content_encoding = 'zstd'
+
+    def __init__(self, app: ASGIApp, minimum_size: int, level: int = 3) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        return self.compressor.compress(body) + self.compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK if more_body else zstandard.COMPRESSOBJ_FLUSH_FINISH
+        )
+
+
+def get_encodings(accept_encoding: str) -> set:
+    encodings = set()
+
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+
+        # "gzip;q=0" refuses the encoding
+        try:
+            if params.startswith('q=') and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+
+        encodings.add(name.strip().lower())
+
+    return encodings
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses of at least minimum_size bytes with zstd when the
+    client accepts it and the zstandard package is installed, and with
+    gzip otherwise.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 5, zstd_level: int = 3) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        encodings = get_encodings(Headers(scope=scope).get('Accept-Encoding', ''))
+
+        if zstandard is not None and 'zstd' in encodings:
+            responder = ZstdResponder(self.app, self.minimum_size, self.zstd_level)
+        elif 'gzip' in encodings:
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+
+        await responder(scope, receive, send)
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+from sqlalchemy import delete as delete_db, func, literal, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Tuple
+
+import models
+
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+
+def insert_or_add(session: AsyncSession):
+    # a row which already holds the bucket gets the traffic added instead of a second row
+    table = models.TrafficHistory.__table__
+    dialect_name = session.bind.dialect.name
+
+    if dialect_name in ('mysql', 'mariadb'):
+        statement = mysql.insert(table)
+
+        return statement.on_duplicate_key_update(
+            uplink=table.c.uplink + statement.inserted.uplink,
+            downlink=table.c.downlink + statement.inserted.downlink
+        )
+
+    statement = (postgresql if dialect_name == 'postgresql' else sqlite).insert(table)
+
+    return statement.on_conflict_do_update(
+        index_elements=['resolution', 'bucket_date', 'inbound_tag', 'email'],
+        set_={
+            'uplink': table.c.uplink + statement.excluded.uplink,
+            'downlink': table.c.downlink + statement.excluded.downlink
+        }
+    )
+
+def get_bucket_date(date: datetime, resolution: int) -> datetime:
+    if resolution == DAY:
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if resolution == HOUR:
+        return date.replace(minute=0, second=0, microsecond=0)
+
+    return date.replace(second=0, microsecond=0)
+
+async def add_samples(
+        session: AsyncSession,
+        date: datetime,
+        traffic: Dict[Tuple[str, str], List[int]]
+) -> None:
+    # (inbound_tag, email) -> [uplink, downlink], inbound totals are added here
+    inbounds: Dict[str, List[int]] = {}
+    rows = []
+
+    for (inbound_tag, email), (uplink, downlink) in traffic.items():
+        if uplink == 0 and downlink == 0:
+            continue
+
+        rows.append({'inbound_tag': inbound_tag, 'email': email, 'uplink': uplink, 'downlink': downlink})
+
+        inbounds.setdefault(inbound_tag, [0, 0])
+        inbounds[inbound_tag][0] += uplink
+        inbounds[inbound_tag][1] += downlink
+
+    rows.extend(
+        {'inbound_tag': inbound_tag, 'email': '', 'uplink': uplink, 'downlink': downlink}
+        for inbound_tag, (uplink, downlink) in inbounds.items()
+    )
+
+    if not rows:
+        return
+
+    bucket_date = get_bucket_date(date, MINUTE)
+
+    await session.execute(
+        insert_or_add(session),
+        [{**row, 'resolution': MINUTE, 'bucket_date': bucket_date} for row in rows]
+    )
+
+async def get_usage(
+        session: AsyncSession,
+        inbound_tag: str,
+        email: str | None,
+        start: datetime,
+        end: datetime
+) -> Tuple[int, int]:
+    result = await session.execute(
+        select(
+            func.coalesce(func.sum(models.TrafficHistory.uplink), 0),
+            func.coalesce(func.sum(models.TrafficHistory.downlink), 0)
+        ).filter(
+            models.TrafficHistory.inbound_tag == inbound_tag,
+            models.TrafficHistory.email == (email or ''),
+            models.TrafficHistory.bucket_date >= start,
+            models.TrafficHistory.bucket_date < end
+        )
+    )
+
+    uplink, downlink = result.one()
+    return int(uplink), int(downlink)
+
+async def get_oldest_bucket_date(session: AsyncSession, resolution: int) -> datetime | None:
+    result = await session.execute(
+        select(func.min(models.TrafficHistory.bucket_date)).filter(models.TrafficHistory.resolution == resolution)
+    )
+
+    return result.scalar()
+
+async def rollup(
+        session: AsyncSession,
+        resolution: int,
+        target_resolution: int,
+        bucket_date: datetime
+) -> None:
+    # merge all rows of one target bucket into one row per user and inbound
+    end = bucket_date + timedelta(seconds=target_resolution)
+    window = (
+        models.TrafficHistory.resolution == resolution,
+        models.TrafficHistory.bucket_date >= bucket_date,
+        models.TrafficHistory.bucket_date < end
+    )
+
+    await session.execute(
+        insert_or_add(session).from_select(
+            ['resolution', 'bucket_date', 'inbound_tag', 'email', 'uplink', 'downlink'],
+            select(
+                literal(target_resolution),
+                literal(bucket_date, models.TrafficHistory.bucket_date.type),
+                models.TrafficHistory.inbound_tag,
+                models.TrafficHistory.email,
+                func.sum(models.TrafficHistory.uplink),
+                func.sum(models.TrafficHistory.downlink)
+            ).filter(*window).group_by(
+                models.TrafficHistory.inbound_tag,
+                models.TrafficHistory.email
+            )
+        )
+    )
+
+    await session.execute(delete_db(models.TrafficHistory).filter(*window))
+
+async def prune(session: AsyncSession, before: datetime) -> None:
+    await session.execute(delete_db(models.TrafficHistory).filter(models.TrafficHistory.bucket_date < before))
@@ -0,0 +1,64 @@
+from datetime import datetime
+from sqlalchemy import delete as delete_db, func, select, update as update_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+
+import models, schemas
+
+
+async def enqueue_operation(
+        session: AsyncSession,
+        inbound_tag: str,
+        email: str,
+        node: str | None,
+        action: schemas.OperationEnum
+) -> None:
+    # only the latest operation per user matters, it replaces the pending one
+    await session.execute(delete_db(models.XrayOperation).filter(
+        models.XrayOperation.inbound_tag == inbound_tag,
+        models.XrayOperation.email == email
+    ))
+
+    session.add(models.XrayOperation(
+        inbound_tag=inbound_tag,
+        email=email,
+        node=node,
+        action=action.value,
+        next_attempt_date=datetime.now()
+    ))
+
+async def get_due_operations(
+        session: AsyncSession,
+        now: datetime,
+        limit: int = 100
+) -> List[models.XrayOperation]:
+    result = await session.execute(
+        select(models.XrayOperation)
+        .filter(models.XrayOperation.next_attempt_date <= now)
+        .order_by(models.XrayOperation.next_attempt_date, models.XrayOperation.id)
+        .limit(limit)
+    )
+
+    return result.scalars().all()
+
+async def count_operations(session: AsyncSession) -> int:
+    result = await session.execute(select(func.count()).select_from(models.XrayOperation))
+    return result.scalar()
+
+async def delete_operation(session: AsyncSession, operation_id: int) -> None:
+    await session.execute(delete_db(models.XrayOperation).filter(models.XrayOperation.id == operation_id))
+
+async def reschedule_operation(
+        session: AsyncSession,
+        operation_id: int,
+        attempts: int,
+        next_attempt_date: datetime,
+        last_error: str
+) -> None:
+    await session.execute(update_db(models.XrayOperation).filter(
+        models.XrayOperation.id == operation_id
+    ).values(
+        attempts=attempts,
+        next_attempt_date=next_attempt_date,
+        last_error=last_error[:1024]
+    ))
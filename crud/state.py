@@ -0,0 +1,11 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+
+async def get_state(session: AsyncSession, key: str) -> int | None:
+    state = await session.get(models.DaemonState, key)
+    return state.value if state else None
+
+async def set_state(session: AsyncSession, key: str, value: int) -> None:
+    await session.merge(models.DaemonState(key=key, value=value))
@@ -1,9 +1,12 @@
-from sqlalchemy import func, select, Select, desc, update as update_db
+from sqlalchemy import func, select, tuple_, Select, desc, update as update_db
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Tuple
+from datetime import datetime
 
 import secrets
 
+from changes import CHANGES
+
 import models, schemas
 
 
@@ -12,9 +15,12 @@ async def get_users(
         inbound_tag: str = None,
         email: str = None,
         is_traffic_overage: bool = None,
-        is_active: bool = None
+        is_active: bool = None,
+        emails: List[str] = None,
+        columns: List = None
 ) -> Tuple[List[models.User], int]:
-    query = select(models.User)
+    # plain rows of the columns instead of User objects, when they are only serialized
+    query = select(*columns) if columns else select(models.User)
     count_query = select(func.count()).select_from(models.User)
 
     def add_filters(query: Select) -> Select:
@@ -30,6 +36,9 @@ async def get_users(
         if email:
             query = query.filter(models.User.email == email)
 
+        if emails is not None:
+            query = query.filter(models.User.email.in_(emails))
+
         return query
 
     query = add_filters(query)
@@ -39,10 +48,21 @@ async def get_users(
     count_result = await session.execute(count_query)
 
     return (
-        result.scalars().all(),
+        result.all() if columns else result.scalars().all(),
         count_result.scalar()
     )
 
+async def get_users_by_keys(
+        session: AsyncSession,
+        keys: List[Tuple[str, str]]
+) -> List[models.User]:
+    # one statement for all users, without the COUNT of get_users
+    result = await session.execute(select(models.User).filter(
+        tuple_(models.User.inbound_tag, models.User.email).in_(keys)
+    ))
+
+    return result.scalars().all()
+
 async def create_user(
         session: AsyncSession,
         inbound_tag: str,
@@ -77,7 +97,11 @@ async def create_user(
         cipher_type=user_data.cipher_type.value if user_data.cipher_type else None,
         uuid=user_data.uuid,
         flow=user_data.flow,
-        limit=user_data.limit
+        node=user_data.node,
+        limit=user_data.limit,
+        max_ips=user_data.max_ips,
+        expires_at=user_data.expires_at,
+        version=CHANGES.next(session, inbound_tag)
     )
 
     session.add(user)
@@ -91,31 +115,152 @@ async def update_user(
         session: AsyncSession,
         inbound_tag: str,
         email: str,
-        user_data: schemas.UpdateUser
+        user_data: schemas.UpdateUser,
+        commit: bool = True
+) -> None:
+    values = user_data.model_dump(
+        exclude_unset=True,
+        exclude_none=True
+    )
+
+    # an update without values would not be valid SQL
+    if values:
+        values['version'] = CHANGES.next(session, inbound_tag)
+
+        await session.execute(update_db(models.User).filter(
+            models.User.inbound_tag == inbound_tag,
+            models.User.email == email
+        ).values(**values))
+
+    if commit:
+        await session.commit()
+
+async def set_expires_at(
+        session: AsyncSession,
+        inbound_tag: str,
+        email: str,
+        expires_at: datetime | None
 ) -> None:
+    # update_user skips None, clearing the expiry needs its own statement
     await session.execute(update_db(models.User).filter(
         models.User.inbound_tag == inbound_tag,
         models.User.email == email
     ).values(
-        **user_data.model_dump(
-            exclude_unset=True,
-            exclude_none=True
-        )
+        expires_at=expires_at,
+        version=CHANGES.next(session, inbound_tag)
     ))
 
-    await session.commit()
+async def get_expiring_users(session: AsyncSession) -> List[Tuple[str, str, datetime]]:
+    result = await session.execute(select(
+        models.User.inbound_tag,
+        models.User.email,
+        models.User.expires_at
+    ).filter(models.User.expires_at.is_not(None)))
+
+    return result.all()
+
+async def add_traffic(
+        session: AsyncSession,
+        email: str,
+        traffic: int
+) -> None:
+    await session.execute(update_db(models.User).filter(
+        models.User.email == email,
+        models.User.traffic >= 0
+    ).values(
+        traffic=models.User.traffic + traffic,
+        version=CHANGES.next(session, None)
+    ))
+
+async def set_traffic(
+        session: AsyncSession,
+        email: str,
+        traffic: int
+) -> None:
+    await session.execute(update_db(models.User).filter(
+        models.User.email == email,
+        models.User.traffic >= 0
+    ).values(
+        traffic=traffic,
+        version=CHANGES.next(session, None)
+    ))
 
 async def delete_user(
         session: AsyncSession,
         inbound_tag: str,
-        email: str
-) -> bool:
+        email: str,
+        tombstone: bool = True
+) -> (models.User | None):
     usersList, total = await get_users(session, inbound_tag, email)
 
     if total != 1:
-        return False
+        return None
+
+    # readers of the change feed learn about the deletion from the tombstone,
+    # a user whose creation is rolled back gets none
+    if tombstone:
+        userTombstone = (await session.execute(select(models.UserTombstone).filter(
+            models.UserTombstone.inbound_tag == inbound_tag,
+            models.UserTombstone.email == email
+        ))).scalar_one_or_none()
+
+        if userTombstone is None:
+            userTombstone = models.UserTombstone(inbound_tag=inbound_tag, email=email)
+            session.add(userTombstone)
+
+        userTombstone.version = CHANGES.next(session, inbound_tag)
+        userTombstone.deleted_date = datetime.now()
 
     await session.delete(usersList[0])
     await session.commit()
 
-    return True
+    return usersList[0]
+
+async def get_changes(
+        session: AsyncSession,
+        since: int,
+        until: int,
+        inbound_tag: str = None,
+        limit: int = 1000
+) -> Tuple[List[models.User], List[models.UserTombstone]]:
+    query = select(models.User).filter(
+        models.User.version > since,
+        models.User.version <= until
+    )
+    tombstones_query = select(models.UserTombstone).filter(
+        models.UserTombstone.version > since,
+        models.UserTombstone.version <= until
+    )
+
+    if inbound_tag:
+        query = query.filter(models.User.inbound_tag == inbound_tag)
+        tombstones_query = tombstones_query.filter(models.UserTombstone.inbound_tag == inbound_tag)
+
+    result = await session.execute(query.order_by(models.User.version).limit(limit))
+    tombstones_result = await session.execute(tombstones_query.order_by(models.UserTombstone.version).limit(limit))
+
+    return (
+        result.scalars().all(),
+        tombstones_result.scalars().all()
+    )
+
+async def set_missing_versions(session: AsyncSession) -> None:
+    # rows from before versioning get one, so a full read of the feed returns them
+    await session.execute(update_db(models.User).filter(
+        models.User.version.is_(None)
+    ).values(
+        version=models.User.id
+    ))
+    await session.commit()
+
+async def get_versions(session: AsyncSession) -> List[Tuple[str, int]]:
+    result = await session.execute(select(
+        models.User.inbound_tag,
+        func.max(models.User.version)
+    ).group_by(models.User.inbound_tag))
+    tombstones_result = await session.execute(select(
+        models.UserTombstone.inbound_tag,
+        func.max(models.UserTombstone.version)
+    ).group_by(models.UserTombstone.inbound_tag))
+
+    return result.all() + tombstones_result.all()
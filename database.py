@@ -1,17 +1,33 @@
-from typing import AsyncGenerator
-from sqlalchemy import Connection, inspect
+from datetime import datetime
+from typing import AsyncGenerator, Dict, List, Tuple
+from sqlalchemy import Connection, delete, func, inspect, select, text, update
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.exc import SQLAlchemyError
 from dotenv import load_dotenv
 
-import os
+import asyncio, grpc, os
 
-from schemas import XrayError
-from crud.users import get_users
+from crud import history, state
+from crud.users import add_traffic, get_users, get_versions, set_missing_versions, set_traffic
 
 from loki_logger import LOGGER
-import models
-from xray import Xray
+import metrics, models, tracing
+from xray import CircuitBreaker, Xray, channel_options
+from xray_cluster import XrayCluster, parse_inbounds, parse_nodes
+from provisioning import PROVISIONING, RestartWatcher, provision_users
+from xray_config import ConfigSnapshot
+from reconciliation import Reconciler
+from outbox import XrayOutbox
+from traffic_journal import TrafficJournal
+from loop_monitor import LoopMonitor
+from probes import HealthProbes
+from rates import RateTracker
+from quota import QuotaGuard
+from leaderboard import Leaderboards
+from ip_limit import IpLimiter
+from expiry import ExpiryScheduler
+from webhooks import WebhookDispatcher
+from changes import CHANGES
 
 
 load_dotenv('.env')
@@ -20,15 +36,170 @@ DATABASE_URL = os.getenv('DATABASE_CONNECTION_STRING')
 if not DATABASE_URL:
     raise ValueError('DATABASE_CONNECTION_STRING не задан в .env')
 
-XRAY_INSTANCE = Xray(
-	os.getenv("GRPC_URL"),
-	int(os.getenv("GRPC_PORT"))
+GRPC_CHANNEL_POOL_SIZE = int(os.getenv('GRPC_CHANNEL_POOL_SIZE', 1))
+
+def create_xray(name: str, api_host: str, api_port: int) -> Xray:
+	return Xray(
+		api_host,
+		api_port,
+		options=channel_options(
+			keepalive_time_ms=int(os.getenv('GRPC_KEEPALIVE_TIME_MS', 300000)),
+			keepalive_timeout_ms=int(os.getenv('GRPC_KEEPALIVE_TIMEOUT_MS', 20000)),
+			max_message_length=int(os.getenv('GRPC_MAX_MESSAGE_LENGTH', 64 * 1024 * 1024)),
+			initial_reconnect_backoff_ms=int(os.getenv('GRPC_INITIAL_RECONNECT_BACKOFF_MS', 1000)),
+			max_reconnect_backoff_ms=int(os.getenv('GRPC_MAX_RECONNECT_BACKOFF_MS', 10000)),
+			local_subchannel_pool=GRPC_CHANNEL_POOL_SIZE > 1,
+		),
+		compression={
+			'gzip': grpc.Compression.Gzip,
+			'deflate': grpc.Compression.Deflate,
+		}.get(os.getenv('GRPC_COMPRESSION', 'none').lower(), grpc.Compression.NoCompression),
+		pool_size=GRPC_CHANNEL_POOL_SIZE,
+		read_timeout=float(os.getenv('GRPC_READ_TIMEOUT_SECONDS', 2)),
+		write_timeout=float(os.getenv('GRPC_WRITE_TIMEOUT_SECONDS', 5)),
+		read_retries=int(os.getenv('GRPC_READ_RETRIES', 2)),
+		retry_backoff=float(os.getenv('GRPC_RETRY_BACKOFF_SECONDS', 0.1)),
+		bulk_timeout=float(os.getenv('GRPC_BULK_TIMEOUT_SECONDS', 30)),
+		breaker=CircuitBreaker(
+			failure_threshold=int(os.getenv('GRPC_BREAKER_FAILURES', 5)),
+			recovery_timeout=float(os.getenv('GRPC_BREAKER_RESET_SECONDS', 15))
+		),
+		name=name
+	)
+
+XRAY_NODES = parse_nodes(os.getenv('GRPC_NODES', '')) or {
+	'default': f"{os.getenv('GRPC_URL')}:{os.getenv('GRPC_PORT')}"
+}
+
+XRAY_INSTANCE = XrayCluster(
+	nodes={
+		name: create_xray(name, target.rpartition(':')[0], int(target.rpartition(':')[2]))
+		for name, target in XRAY_NODES.items()
+	},
+	inbounds=parse_inbounds(os.getenv('GRPC_NODE_INBOUNDS', ''))
 )
 
+PROCESSING_INTERVAL_SECONDS = float(os.getenv('PROCESSING_INTERVAL_SECONDS', 20))
+
+PROVISIONING_CONCURRENCY = int(os.getenv('PROVISIONING_CONCURRENCY', 64))
+PROVISIONING_IN_BACKGROUND = os.getenv('PROVISIONING_IN_BACKGROUND', 'false').lower() == 'true'
+
 async_engine = create_async_engine(DATABASE_URL)
+metrics.instrument_engine(async_engine)
+tracing.instrument_engine(async_engine)
 
 SessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
+async def get_active_users() -> List[models.User]:
+    async with SessionLocal() as session:
+        usersList, _ = await get_users(session, is_active=True)
+
+    return usersList
+
+async def get_all_users() -> List[models.User]:
+    async with SessionLocal() as session:
+        usersList, _ = await get_users(session)
+
+    return usersList
+
+XRAY_CONFIG_SNAPSHOT = ConfigSnapshot(
+    os.getenv('XRAY_CONFIG_SNAPSHOT_PATH'),
+    XRAY_INSTANCE,
+    load_users=get_active_users,
+    template_path=os.getenv('XRAY_CONFIG_TEMPLATE_PATH')
+)
+
+XRAY_RESTART_WATCHER = RestartWatcher(
+    XRAY_INSTANCE,
+    load_users=get_active_users,
+    concurrency=PROVISIONING_CONCURRENCY
+)
+
+XRAY_RECONCILER = Reconciler(
+    XRAY_INSTANCE,
+    load_users=get_all_users,
+    concurrency=int(os.getenv('RECONCILE_CONCURRENCY', 32)),
+    verified_ttl=float(os.getenv('RECONCILE_VERIFIED_TTL_SECONDS', 3600))
+)
+
+XRAY_OUTBOX = XrayOutbox(
+    SessionLocal,
+    XRAY_INSTANCE,
+    concurrency=int(os.getenv('OUTBOX_CONCURRENCY', 16)),
+    base_backoff=float(os.getenv('OUTBOX_BACKOFF_SECONDS', 1)),
+    max_backoff=float(os.getenv('OUTBOX_MAX_BACKOFF_SECONDS', 300))
+)
+
+WEBHOOKS = WebhookDispatcher(
+    [url.strip() for url in os.getenv('WEBHOOK_URLS', '').split(',') if url.strip()],
+    secret=os.getenv('WEBHOOK_SECRET'),
+    batch_size=int(os.getenv('WEBHOOK_BATCH_SIZE', 100)),
+    flush_interval=float(os.getenv('WEBHOOK_FLUSH_INTERVAL_SECONDS', 1)),
+    max_pending=int(os.getenv('WEBHOOK_MAX_PENDING', 10000)),
+    max_attempts=int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5)),
+    base_backoff=float(os.getenv('WEBHOOK_BACKOFF_SECONDS', 1)),
+    max_backoff=float(os.getenv('WEBHOOK_MAX_BACKOFF_SECONDS', 60)),
+    timeout=float(os.getenv('WEBHOOK_TIMEOUT_SECONDS', 5))
+)
+
+def on_expire(keys: List[Tuple[str, str]]) -> None:
+    XRAY_OUTBOX.schedule()
+    XRAY_CONFIG_SNAPSHOT.schedule()
+
+    for inbound_tag, email in keys:
+        WEBHOOKS.emit('user.expired', inbound_tag, email)
+
+EXPIRY = ExpiryScheduler(SessionLocal, on_expire=on_expire)
+
+TRAFFIC_JOURNAL = TrafficJournal(os.getenv('TRAFFIC_JOURNAL_PATH', 'traffic.journal'))
+
+RATE_TRACKER = RateTracker(
+    half_life=float(os.getenv('RATE_HALF_LIFE_SECONDS', 60)),
+    capacity=int(os.getenv('RATE_SAMPLES', 16))
+)
+
+IP_LIMITER = IpLimiter(XRAY_INSTANCE, concurrency=int(os.getenv('IP_LIMIT_CONCURRENCY', 16)))
+
+LEADERBOARDS = Leaderboards(size=int(os.getenv('LEADERBOARD_SIZE', 100)))
+
+QUOTA_GUARD = QuotaGuard(
+    RATE_TRACKER,
+    cycle_interval=PROCESSING_INTERVAL_SECONDS,
+    min_interval=float(os.getenv('QUOTA_POLL_INTERVAL_SECONDS', 1)),
+    horizon=float(os.getenv('QUOTA_HOT_HORIZON_CYCLES', 2))
+)
+
+HEALTH_PROBES = HealthProbes(
+    SessionLocal,
+    XRAY_INSTANCE,
+    PROVISIONING,
+    database_timeout=float(os.getenv('HEALTH_DATABASE_TIMEOUT_SECONDS', 2)),
+    interval=float(os.getenv('HEALTH_PROBE_INTERVAL_SECONDS', 5)),
+    max_cycle_age=float(os.getenv('HEALTH_MAX_CYCLE_AGE_SECONDS', 60)),
+    max_live_cycle_age=float(os.getenv('HEALTH_LIVE_MAX_CYCLE_AGE_SECONDS', 600))
+)
+
+LOOP_MONITOR = LoopMonitor(
+    interval=float(os.getenv('LOOP_MONITOR_INTERVAL_SECONDS', 0.1)),
+    threshold=float(os.getenv('LOOP_MONITOR_THRESHOLD_SECONDS', 0.25))
+)
+
+# queue depths are read on scrape, nothing is updated on the hot path
+metrics.OUTBOX_PENDING.set_function(lambda: XRAY_OUTBOX.pending)
+metrics.TRAFFIC_JOURNAL_PENDING.set_function(lambda: len(TRAFFIC_JOURNAL.pending))
+metrics.WEBHOOK_PENDING.set_function(lambda: len(WEBHOOKS.pending))
+metrics.PROVISIONING_REMAINING.set_function(lambda: PROVISIONING.total - PROVISIONING.done)
+
+for kind in ('missing', 'extra', 'unknown', 'failed'):
+    metrics.RECONCILIATION_DRIFT.labels(kind).set_function(
+        lambda kind=kind: XRAY_RECONCILER.last_result.get(kind, 0)
+    )
+
+for name, node in XRAY_INSTANCE.nodes.items():
+    metrics.XRAY_BREAKER_OPEN.labels(name).set_function(
+        lambda breaker=node.breaker: breaker.state != breaker.CLOSED
+    )
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with SessionLocal() as session:
         try:
@@ -41,46 +212,121 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
         finally:
             await session.close()
 
+def merge_traffic_history(sync_conn: Connection):
+    # samples of one bucket used to be separate rows, they have to be merged before the unique index is created
+    table = models.TrafficHistory.__table__
+    key = (table.c.resolution, table.c.bucket_date, table.c.inbound_tag, table.c.email)
+
+    duplicates = sync_conn.execute(
+        select(*key, func.min(table.c.id), func.sum(table.c.uplink), func.sum(table.c.downlink))
+        .group_by(*key)
+        .having(func.count() > 1)
+    ).all()
+
+    for *values, id, uplink, downlink in duplicates:
+        sync_conn.execute(update(table).filter(table.c.id == id).values(uplink=uplink, downlink=downlink))
+        sync_conn.execute(delete(table).filter(*(column == value for column, value in zip(key, values)), table.c.id != id))
+
+def migrate_database(sync_conn: Connection):
+    # add columns which were introduced after the table had been created
+    inspector = inspect(sync_conn)
+
+    for table in models.Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+
+            if table is models.TrafficHistory.__table__ and index.unique:
+                merge_traffic_history(sync_conn)
+
+            index.create(bind=sync_conn, checkfirst=True)
+
+async def load_versions():
+    async with SessionLocal() as session:
+        await set_missing_versions(session)
+        CHANGES.load(await get_versions(session))
+
+async def replay_traffic_journal():
+    batches = TRAFFIC_JOURNAL.read()
+
+    async with SessionLocal() as session:
+        last_batch_id = await state.get_state(session, TrafficJournal.STATE_KEY)
+
+        # without a committed batch the journal was never used and Xray counters still hold totals
+        if last_batch_id is None and not batches:
+            return
+
+        TRAFFIC_JOURNAL.is_initialized = True
+        TRAFFIC_JOURNAL.last_batch_id = max(TRAFFIC_JOURNAL.last_batch_id, last_batch_id or 0)
+
+        replayed = [batch_id for batch_id in sorted(batches) if batch_id > (last_batch_id or 0)]
+        traffic: Dict[str, List[int]] = {}
+
+        for batch_id in replayed:
+            for email, (uplink, downlink) in batches[batch_id].items():
+                traffic.setdefault(email, [0, 0])
+                traffic[email][0] += uplink
+                traffic[email][1] += downlink
+
+        for email, (uplink, downlink) in traffic.items():
+            # the first cycle crashed, its batches hold the period totals as that cycle would have taken them
+            if last_batch_id is None:
+                await set_traffic(session, email, uplink + downlink)
+            else:
+                await add_traffic(session, email, uplink + downlink)
+
+        # recovered traffic goes to the history like the traffic of a cycle
+        if traffic:
+            usersList, _ = await get_users(session, emails=list(traffic))
+
+            await history.add_samples(session, datetime.now().replace(microsecond=0), {
+                (user.inbound_tag, user.email): traffic[user.email] for user in usersList
+            })
+
+        await state.set_state(session, TrafficJournal.STATE_KEY, TRAFFIC_JOURNAL.last_batch_id)
+        await session.commit()
+
+    TRAFFIC_JOURNAL.commit()
+
+    if replayed:
+        LOGGER.info(
+            'TRAFFIC JOURNAL REPLAY',
+            extra={
+                'tags': {
+                    'batches': len(replayed)
+                }
+            }
+        )
+
 async def import_database():
     async with async_engine.connect() as conn:
         def create_database(sync_conn: Connection):
-            if not inspect(sync_conn).has_table('users'):
-                models.Base.metadata.create_all(bind=sync_conn)
+            models.Base.metadata.create_all(bind=sync_conn)
+            migrate_database(sync_conn)
 
+            sync_conn.commit()
             sync_conn.close()
 
         await conn.run_sync(lambda sync_conn: create_database(sync_conn))
 
+    await load_versions()
+    await replay_traffic_journal()
+    await EXPIRY.load()
+
     session = SessionLocal()
 
     try:
-        usersList, total = await get_users(session)
-
-        if total > 0:
-            for user in usersList:
-                if user.is_active == True:
-                    result = await XRAY_INSTANCE.add_user(
-                        inbound_tag=user.inbound_tag,
-                        email=user.email,
-                        level=user.level,
-                        type=user.type,
-                        password=user.password,
-                        cipher_type=user.cipher_type,
-                        uuid=user.uuid,
-                        flow=user.flow,
-                    )
-
-                    if type(result) is XrayError:
-                        LOGGER.error(
-                            'XRAY ERROR',
-                            extra={
-                                'tags': {
-                                    'error_msg': result.message,
-                                    'user.email': user.email
-                                }
-                            },
-                            exc_info=True,
-                        )
+        usersList, _ = await get_users(session, is_active=True)
 
     except SQLAlchemyError as e:
         await session.rollback()
@@ -88,3 +334,29 @@ async def import_database():
 
     finally:
         await session.close()
+
+    XRAY_CONFIG_SNAPSHOT.schedule()
+
+    if PROVISIONING_IN_BACKGROUND:
+        PROVISIONING.task = asyncio.create_task(provision_active_users(usersList))
+    else:
+        await provision_active_users(usersList)
+
+async def provision_active_users(usersList: List[models.User]):
+    try:
+        await provision_users(XRAY_INSTANCE, usersList, PROVISIONING_CONCURRENCY, state=PROVISIONING)
+
+    except Exception as e:
+        LOGGER.error(
+            'PROVISIONING ERROR',
+            extra={
+                'tags': {
+                    'error_type': type(e).__name__,
+                    'error_msg': str(e)
+                }
+            },
+            exc_info=True,
+        )
+
+    finally:
+        PROVISIONING.is_ready = True
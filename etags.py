@@ -0,0 +1,27 @@
+from fastapi import HTTPException, Request, Response, status
+
+import os
+
+
+# versions and cycle numbers start over with a new process or database, tags of an earlier one must not match
+BOOT_ID = os.urandom(4).hex()
+
+def make_etag(*parts) -> str:
+    return 'W/"' + '-'.join(str(part) for part in (BOOT_ID, *parts)) + '"'
+
+def check_etag(request: Request, response: Response, etag: str) -> None:
+    """
+    Set the ETag of the response and answer 304 when the client already has it,
+    called before the data is read, so an unchanged poll costs no query
+    """
+    response.headers['ETag'] = etag
+    if_none_match = request.headers.get('If-None-Match')
+
+    if not if_none_match:
+        return
+
+    # weak comparison, the W/ prefix is ignored on both sides
+    tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+
+    if '*' in tags or etag.removeprefix('W/') in tags:
+        raise HTTPException(status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
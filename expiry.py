@@ -0,0 +1,168 @@
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import asyncio, heapq, time
+
+from crud import operations, users
+from loki_logger import LOGGER
+
+import schemas
+
+
+class ExpiryScheduler:
+    """
+    Min-heap of expiry times with one task sleeping until the earliest.
+    Expired users are deleted together with a queued Xray removal, so no
+    cycle has to scan the users table for them.
+    """
+
+    def __init__(self, session_maker: async_sessionmaker, on_expire: Callable[[List[Tuple[str, str]]], None]) -> None:
+        self.session_maker = session_maker
+        self.on_expire = on_expire
+
+        self.heap: List[Tuple[float, str, str]] = []
+        self.due: Dict[Tuple[str, str], float] = {}
+        self.expired = 0
+
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    async def load(self) -> None:
+        async with self.session_maker() as session:
+            for inbound_tag, email, expires_at in await users.get_expiring_users(session):
+                self.schedule(inbound_tag, email, expires_at)
+
+    def schedule(self, inbound_tag: str, email: str, expires_at: datetime | None) -> None:
+        key = (inbound_tag, email)
+
+        if expires_at is None:
+            self.due.pop(key, None)
+            self.compact()
+            return
+
+        due = expires_at.timestamp()
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, inbound_tag, email))
+        self.compact()
+
+        # the sleeping task has to wake up earlier
+        if self.heap[0][0] == due:
+            self.wakeup.set()
+
+    def compact(self) -> None:
+        # removed and rescheduled users leave stale entries, the heap is rebuilt once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.due):
+            self.heap = [(due, inbound_tag, email) for (inbound_tag, email), due in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def pop_due(self, now: float) -> List[Tuple[str, str]]:
+        keys = []
+
+        while self.heap and self.heap[0][0] <= now:
+            due, inbound_tag, email = heapq.heappop(self.heap)
+            key = (inbound_tag, email)
+
+            # entries replaced by a later schedule are skipped
+            if self.due.get(key) != due:
+                continue
+
+            del self.due[key]
+            keys.append(key)
+
+        return keys
+
+    async def run(self) -> None:
+        while True:
+            self.wakeup.clear()
+
+            # a stale entry on top would wake the task for nothing
+            while self.heap and self.due.get(self.heap[0][1:]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            keys = self.pop_due(time.time())
+
+            if not keys:
+                continue
+
+            try:
+                await self.expire(keys)
+
+            except Exception as e:
+                # the users are tried again after a pause, a failing database should not spin the loop
+                for inbound_tag, email in keys:
+                    self.due[(inbound_tag, email)] = time.time() + 5
+                    heapq.heappush(self.heap, (self.due[(inbound_tag, email)], inbound_tag, email))
+
+                LOGGER.error(
+                    'EXPIRY ERROR',
+                    extra={
+                        'tags': {
+                            'error_type': type(e).__name__,
+                            'error_msg': str(e)
+                        }
+                    },
+                    exc_info=True,
+                )
+
+    async def expire(self, keys: List[Tuple[str, str]]) -> None:
+        expired_users = []
+        expired_keys = []
+
+        async with self.session_maker() as session:
+            for inbound_tag, email in keys:
+                usersList, total = await users.get_users(session, inbound_tag, email)
+
+                if total != 1:
+                    continue
+
+                # the removal is queued in the same transaction as the deletion
+                await operations.enqueue_operation(
+                    session,
+                    inbound_tag,
+                    email,
+                    usersList[0].node,
+                    schemas.OperationEnum.remove
+                )
+                await users.delete_user(session, inbound_tag, email)
+
+                expired_users.append(email)
+                expired_keys.append((inbound_tag, email))
+
+        if not expired_users:
+            return
+
+        self.expired += len(expired_users)
+        self.on_expire(expired_keys)
+
+        LOGGER.info(
+            'EXPIRY RESULT',
+            extra={
+                'tags': {
+                    'expired_users': ', '.join(expired_users)
+                }
+            }
+        )
@@ -0,0 +1,33 @@
+from typing import Any, List, Sequence
+from dotenv import load_dotenv
+
+import os, pydantic_core
+
+import models, schemas
+
+
+load_dotenv('.env')
+
+FAST_JSON_RESPONSES = os.getenv('FAST_JSON_RESPONSES', 'false').lower() == 'true'
+
+# columns in the order of ReadUser, fields without a column keep their default
+USER_COLUMNS = [name for name in schemas.ReadUser.model_fields if name in models.User.__table__.columns]
+USER_DEFAULTS = {
+    name: field.default
+    for name, field in schemas.ReadUser.model_fields.items()
+    if name not in USER_COLUMNS
+}
+
+def get_user_columns() -> List[Any]:
+    return [models.User.__table__.columns[name] for name in USER_COLUMNS]
+
+def dump_users(rows: Sequence[Sequence[Any]], total: int) -> bytes:
+    """
+    Serialize plain rows of get_user_columns as ReadUsers, without ORM
+    objects, pydantic models and jsonable_encoder. Values of the columns
+    are already of the types of ReadUser, enums are stored as their values.
+    """
+    return pydantic_core.to_json({
+        'users': [dict(zip(USER_COLUMNS, row), **USER_DEFAULTS) for row in rows],
+        'total': total
+    })
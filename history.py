@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+
+import os
+
+from crud import history
+from database import SessionLocal
+from loki_logger import LOGGER
+
+
+MINUTE_RETENTION = timedelta(hours=float(os.getenv('HISTORY_MINUTE_RETENTION_HOURS', 24)))
+HOUR_RETENTION = timedelta(days=float(os.getenv('HISTORY_HOUR_RETENTION_DAYS', 31)))
+RETENTION = timedelta(days=float(os.getenv('HISTORY_RETENTION_DAYS', 365)))
+
+async def rollup_history():
+    now = datetime.now()
+
+    async with SessionLocal() as session:
+        try:
+            for resolution, target_resolution, retention in (
+                (history.MINUTE, history.HOUR, MINUTE_RETENTION),
+                (history.HOUR, history.DAY, HOUR_RETENTION)
+            ):
+                oldest_bucket_date = await history.get_oldest_bucket_date(session, resolution)
+
+                if oldest_bucket_date is None:
+                    continue
+
+                bucket_date = history.get_bucket_date(oldest_bucket_date, target_resolution)
+
+                # only buckets which are complete and older than the retention are rolled up
+                while bucket_date + timedelta(seconds=target_resolution) <= now - retention:
+                    await history.rollup(session, resolution, target_resolution, bucket_date)
+                    await session.commit()
+
+                    bucket_date += timedelta(seconds=target_resolution)
+
+            await history.prune(session, now - RETENTION)
+            await session.commit()
+
+        except SQLAlchemyError as e:
+            await session.rollback()
+
+            LOGGER.error(
+                'HISTORY ERROR (SQL)',
+                extra={
+                    'tags': {
+                        'error_type': type(e).__name__,
+                        'error_msg': str(e)
+                    }
+                },
+                exc_info=True,
+            )
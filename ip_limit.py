@@ -0,0 +1,57 @@
+from typing import Dict, Iterable, List, Tuple
+
+from provisioning import gather_bounded
+from schemas import XrayError
+from xray_cluster import XrayCluster
+
+
+class IpLimiter:
+    """
+    Verifies users whose online count is over their max_ips with the list
+    of their IPs. Lists are cached by the online count they were taken
+    at, so only users whose count changed are queried again.
+    """
+
+    def __init__(self, xray: XrayCluster, concurrency: int = 16) -> None:
+        self.xray = xray
+        self.concurrency = concurrency
+
+        # email -> (online count, IPs)
+        self.cache: Dict[str, Tuple[int, List[str]]] = {}
+
+    async def get_violations(self, candidates: Iterable[Tuple[str, int, int]]) -> Dict[str, List[str]]:
+        """
+        Get IPs of users connected from more than max_ips addresses
+        :param candidates: (email, max_ips, online count)
+        """
+        candidates = list(candidates)
+        stale = [
+            (email, online) for email, _, online in candidates
+            if self.cache.get(email, (None,))[0] != online
+        ]
+
+        async def query(item: Tuple[str, int]):
+            email, online = item
+            ips = await self.xray.get_user_online_ips(email)
+
+            # failed users are queried again next cycle
+            if type(ips) is XrayError:
+                self.cache.pop(email, None)
+                return
+
+            self.cache[email] = (online, sorted(ips))
+
+        await gather_bounded(stale, query, self.concurrency)
+
+        return {
+            email: self.cache[email][1]
+            for email, max_ips, _ in candidates
+            if email in self.cache and len(self.cache[email][1]) > max_ips
+        }
+
+    def retain(self, emails: Iterable[str]) -> None:
+        # users under their limit again do not need a list
+        emails = set(emails)
+
+        for email in [email for email in self.cache if email not in emails]:
+            del self.cache[email]
@@ -0,0 +1,83 @@
+from typing import Dict, List, Tuple
+
+import heapq
+
+
+class Leaderboards:
+    """
+    Top users by traffic, rate and online sessions, per inbound and over
+    all inbounds. Bounded min-heaps are filled while a cycle walks the
+    users and replace the served boards when the cycle commits, so a
+    request costs O(limit) whatever the number of users.
+    """
+
+    METRICS = ('traffic', 'rate', 'online_sessions')
+
+    def __init__(self, size: int = 100) -> None:
+        self.size = size
+
+        # (metric, inbound_tag or None) -> [(value, inbound_tag, email)] sorted descending
+        self.boards: Dict[Tuple[str, str | None], List[Tuple[float, str, str]]] = {}
+        self.users: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+        self.next_boards: Dict[Tuple[str, str | None], List[Tuple[float, str, str]]] = {}
+        self.next_users: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+    def begin(self) -> None:
+        self.next_boards = {}
+        self.next_users = {}
+
+    def push(self, key: Tuple[str, str | None], entry: Tuple[float, str, str]) -> bool:
+        heap = self.next_boards.setdefault(key, [])
+
+        if len(heap) < self.size:
+            heapq.heappush(heap, entry)
+            return True
+
+        if entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+            return True
+
+        return False
+
+    def add(
+        self,
+        inbound_tag: str,
+        email: str,
+        traffic: int,
+        online_sessions: int,
+        upload_rate: float,
+        download_rate: float
+    ) -> None:
+        is_listed = False
+
+        for metric, value in zip(self.METRICS, (traffic, upload_rate + download_rate, online_sessions)):
+            if value <= 0:
+                continue
+
+            for scope in (inbound_tag, None):
+                is_listed = self.push((metric, scope), (value, inbound_tag, email)) or is_listed
+
+        # users pushed out of every heap later are dropped on commit
+        if is_listed:
+            self.next_users[(inbound_tag, email)] = {
+                'traffic': traffic,
+                'online_sessions': online_sessions,
+                'upload_rate': round(upload_rate, 3),
+                'download_rate': round(download_rate, 3)
+            }
+
+    def commit(self) -> None:
+        self.boards = {key: sorted(heap, reverse=True) for key, heap in self.next_boards.items()}
+
+        listed = {(inbound_tag, email) for board in self.boards.values() for _, inbound_tag, email in board}
+        self.users = {key: value for key, value in self.next_users.items() if key in listed}
+
+        self.next_boards = {}
+        self.next_users = {}
+
+    def get_top(self, metric: str, inbound_tag: str = None, limit: int = 10) -> List[Dict[str, float]]:
+        return [
+            {'inbound_tag': user_inbound_tag, 'email': email, **self.users[(user_inbound_tag, email)]}
+            for _, user_inbound_tag, email in self.boards.get((metric, inbound_tag), [])[:limit]
+        ]
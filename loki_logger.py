@@ -80,22 +80,25 @@ class Logger:
 
             resp_body = [chunk async for chunk in response.body_iterator]
             response.body_iterator = iterate_in_threadpool(iter(resp_body))
-
-            try:
-                resp_body = b''.join(resp_body).decode()
-                resp_body = resp_body.translate(str.maketrans({
-                    "-":  r"\-",
-                    "]":  r"\]",
-                    "\\": r"\\",
-                    "^":  r"\^",
-                    "$":  r"\$",
-                    "*":  r"\*",
-                    ".":  r"\."
-                }))
-
-            except:
-                resp_body = resp_body
-                self.resp_body_required = False
+            resp_length = sum(len(chunk) for chunk in resp_body)
+
+            # only the logged part is decoded and escaped, a whole large listing would take seconds
+            if self.resp_body_required:
+                try:
+                    resp_body = b''.join(resp_body)[:1024].decode(errors='ignore')
+                    resp_body = resp_body.translate(str.maketrans({
+                        "-":  r"\-",
+                        "]":  r"\]",
+                        "\\": r"\\",
+                        "^":  r"\^",
+                        "$":  r"\$",
+                        "*":  r"\*",
+                        ".":  r"\."
+                    }))
+
+                except:
+                    resp_body = resp_body
+                    self.resp_body_required = False
 
             process_time = (time.time() - start_time) * 1000
             
@@ -106,7 +109,7 @@ class Logger:
                         'method': request.method,
                         'path': request.url.path,
                         'body': resp_body[:1024] if self.resp_body_required else None,
-                        'length': len(resp_body),
+                        'length': resp_length,
                         'status_code': response.status_code,
                         'process_time_ms': process_time,
                     }
@@ -0,0 +1,137 @@
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List
+
+import asyncio, sys, threading, time, traceback
+
+from loki_logger import LOGGER
+from metrics import EVENT_LOOP_LAG, EVENT_LOOP_STALLS
+
+
+def format_stack(frame) -> str:
+    return ''.join(traceback.format_stack(frame))
+
+
+class LoopMonitor:
+    """
+    Measures how late a periodic sleep wakes up on the event loop. A watchdog
+    thread samples the stack of the loop thread while it is blocked, so the
+    blocking call is recorded and not the code running after it.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        threshold: float = 0.25,
+        window: int = 3000,
+        max_stalls: int = 20
+    ) -> None:
+        self.interval = interval
+        self.threshold = threshold
+
+        self.lags: Deque[float] = deque(maxlen=window)
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=max_stalls)
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: int | None = None
+        self.task: asyncio.Task | None = None
+        self.watchdog: threading.Thread | None = None
+        self.is_running = False
+
+    def start(self) -> None:
+        if self.is_running:
+            return
+
+        self.is_running = True
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+
+        self.task = asyncio.create_task(self.run())
+        self.watchdog = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    async def stop(self) -> None:
+        self.is_running = False
+
+        if self.task is not None:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self) -> None:
+        while self.is_running:
+            start_time = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+            now = time.monotonic()
+            lag = max(now - start_time - self.interval, 0)
+            self.heartbeat = now
+
+            self.lags.append(lag)
+            EVENT_LOOP_LAG.observe(lag)
+
+            if lag >= self.threshold:
+                EVENT_LOOP_STALLS.inc()
+
+                # stack was taken by the watchdog while the loop was blocked
+                if self.stalls and self.stalls[-1]['lag_ms'] is None:
+                    self.stalls[-1]['lag_ms'] = round(lag * 1000, 1)
+
+                    LOGGER.warning(
+                        'EVENT LOOP BLOCKED',
+                        extra={
+                            'tags': {
+                                'lag_ms': self.stalls[-1]['lag_ms'],
+                                'stack': self.stalls[-1]['stack']
+                            }
+                        }
+                    )
+
+    def watch(self) -> None:
+        last_sampled_heartbeat = None
+
+        while self.is_running:
+            time.sleep(self.threshold / 2)
+
+            heartbeat = self.heartbeat
+
+            # one sample per stall, a stall ends when the loop updates the heartbeat
+            if (
+                time.monotonic() - heartbeat < self.interval + self.threshold or
+                heartbeat == last_sampled_heartbeat
+            ):
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+
+            if frame is None:
+                continue
+
+            last_sampled_heartbeat = heartbeat
+            self.stalls.append({
+                'date': datetime.now().replace(microsecond=0),
+                'lag_ms': None,
+                'stack': format_stack(frame)
+            })
+
+    def get_percentiles(self) -> Dict[str, float]:
+        lags = sorted(self.lags)
+
+        if not lags:
+            return {'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+
+        def percentile(value: float) -> float:
+            return round(lags[min(int(len(lags) * value), len(lags) - 1)] * 1000, 3)
+
+        return {
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': round(lags[-1] * 1000, 3)
+        }
+
+    def get_stalls(self) -> List[Dict[str, Any]]:
+        return list(reversed(self.stalls))
@@ -4,14 +4,37 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
-from database import import_database
+from database import (
+    EXPIRY,
+    HEALTH_PROBES,
+    LOOP_MONITOR,
+    PROCESSING_INTERVAL_SECONDS,
+    QUOTA_GUARD,
+    WEBHOOKS,
+    XRAY_INSTANCE,
+    XRAY_OUTBOX,
+    XRAY_RECONCILER,
+    XRAY_RESTART_WATCHER,
+    import_database
+)
 from loki_logger import Logger, LOGGER
-from processing import process
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware
+from tracing import TRACER, TracingMiddleware
+from processing import enforce_quotas, process
+from profiler import PROFILER
+from history import rollup_history
+
+import os
 
 from api import (
     users,
     stats,
-    health
+    history,
+    health,
+    metrics,
+    profile,
+    top
 )
 
 
@@ -20,14 +43,66 @@ scheduler = AsyncIOScheduler()
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     try:
+        # started first, so blocking calls of the startup are recorded too
+        LOOP_MONITOR.start()
+
         await import_database()
+        await HEALTH_PROBES.probe()
+
+        EXPIRY.start()
+        WEBHOOKS.start()
 
         scheduler.add_job(
-            process,
-            trigger=IntervalTrigger(seconds=20),
+            PROFILER.wrap(process),
+            trigger=IntervalTrigger(seconds=PROCESSING_INTERVAL_SECONDS),
             id='processing',
             replace_existing=True
         )
+        scheduler.add_job(
+            enforce_quotas,
+            trigger=IntervalTrigger(seconds=QUOTA_GUARD.min_interval),
+            id='quota',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            HEALTH_PROBES.probe,
+            trigger=IntervalTrigger(seconds=HEALTH_PROBES.interval),
+            id='health_probes',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            XRAY_RESTART_WATCHER.check,
+            trigger=IntervalTrigger(seconds=float(os.getenv('XRAY_RESTART_CHECK_SECONDS', 5))),
+            id='restart_watcher',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            XRAY_RECONCILER.reconcile,
+            trigger=IntervalTrigger(seconds=float(os.getenv('RECONCILE_INTERVAL_SECONDS', 300))),
+            id='reconciliation',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            XRAY_OUTBOX.poll,
+            trigger=IntervalTrigger(seconds=float(os.getenv('OUTBOX_INTERVAL_SECONDS', 5))),
+            id='outbox',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            rollup_history,
+            trigger=IntervalTrigger(seconds=float(os.getenv('HISTORY_ROLLUP_INTERVAL_SECONDS', 300))),
+            id='history_rollup',
+            replace_existing=True
+        )
+
+        if TRACER.exporter is not None:
+            scheduler.add_job(
+                TRACER.flush,
+                trigger=IntervalTrigger(seconds=float(os.getenv('TRACING_EXPORT_INTERVAL_SECONDS', 5))),
+                id='tracing',
+                replace_existing=True
+            )
+
         scheduler.start()
 
         yield
@@ -37,9 +112,18 @@ async def lifespan(_: FastAPI):
 
     finally:
         scheduler.shutdown()
+        await LOOP_MONITOR.stop()
+        await EXPIRY.stop()
+        await WEBHOOKS.stop()
+
+        if TRACER.exporter is not None:
+            await TRACER.flush()
+
+        await XRAY_INSTANCE.close()
 
 app = FastAPI(lifespan=lifespan)
 
+app.add_middleware(TracingMiddleware, name='handler')
 app.add_middleware(
     BaseHTTPMiddleware,
     Logger(
@@ -47,7 +131,19 @@ app.add_middleware(
         req_body_required=True
     )
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv('COMPRESSION_MINIMUM_SIZE', 1024)),
+    gzip_level=int(os.getenv('COMPRESSION_GZIP_LEVEL', 5)),
+    zstd_level=int(os.getenv('COMPRESSION_ZSTD_LEVEL', 3))
+)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 app.include_router(users.router)
 app.include_router(stats.router)
+app.include_router(history.router)
+app.include_router(top.router)
 app.include_router(health.router)
+app.include_router(metrics.router)
+app.include_router(profile.router)
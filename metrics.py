@@ -0,0 +1,172 @@
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import time
+
+
+# buckets are shared by HTTP, gRPC and SQL, they are all expected to be in milliseconds range
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'xray_daemon_http_request_duration_seconds',
+    'HTTP request duration by route template',
+    ('method', 'route', 'status_code'),
+    buckets=LATENCY_BUCKETS
+)
+XRAY_RPC_DURATION = Histogram(
+    'xray_daemon_xray_rpc_duration_seconds',
+    'Xray gRPC call duration per attempt',
+    ('node', 'method', 'code'),
+    buckets=LATENCY_BUCKETS
+)
+DB_QUERY_DURATION = Histogram(
+    'xray_daemon_db_query_duration_seconds',
+    'Database statement duration by statement class',
+    ('statement',),
+    buckets=LATENCY_BUCKETS
+)
+
+PROCESSING_DURATION = Histogram(
+    'xray_daemon_processing_duration_seconds',
+    'Duration of the processing cycle',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+PROCESSING_PHASE_DURATION = Histogram(
+    'xray_daemon_processing_phase_duration_seconds',
+    'Duration of the processing cycle phases',
+    ('phase',),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60)
+)
+PROCESSING_USERS = Gauge(
+    'xray_daemon_processing_users',
+    'Users processed by the last processing cycle'
+)
+PROCESSING_CHANGES = Counter(
+    'xray_daemon_processing_user_changes_total',
+    'Users activated, inactivated and blocked by the processing cycle',
+    ('action',)
+)
+PROCESSING_ERRORS = Counter(
+    'xray_daemon_processing_errors_total',
+    'Failed processing cycles'
+)
+PROCESSING_LAST_SUCCESS = Gauge(
+    'xray_daemon_processing_last_success_timestamp_seconds',
+    'Unix time of the last successful processing cycle'
+)
+
+OUTBOX_PENDING = Gauge(
+    'xray_daemon_outbox_pending_operations',
+    'Xray operations waiting in the outbox'
+)
+TRAFFIC_JOURNAL_PENDING = Gauge(
+    'xray_daemon_traffic_journal_pending_batches',
+    'Drained traffic batches not committed to the database yet'
+)
+PROVISIONING_REMAINING = Gauge(
+    'xray_daemon_provisioning_remaining_users',
+    'Users left to provision at startup'
+)
+RECONCILIATION_DRIFT = Gauge(
+    'xray_daemon_reconciliation_drift_users',
+    'Drift found by the last reconciliation',
+    ('kind',)
+)
+WEBHOOK_PENDING = Gauge(
+    'xray_daemon_webhook_pending_events',
+    'User events waiting to be delivered to webhooks'
+)
+EVENT_LOOP_LAG = Histogram(
+    'xray_daemon_event_loop_lag_seconds',
+    'Delay of the event loop in running a scheduled callback',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+EVENT_LOOP_STALLS = Counter(
+    'xray_daemon_event_loop_stalls_total',
+    'Event loop lags over the blocking threshold'
+)
+XRAY_BREAKER_OPEN = Gauge(
+    'xray_daemon_xray_breaker_open',
+    'Circuit breaker of the node is not closed',
+    ('node',)
+)
+
+
+class Timer:
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.start_time = time.perf_counter()
+
+    def observe(self, *labels: str) -> float:
+        # returns the elapsed time and starts the next phase
+        now = time.perf_counter()
+        elapsed = now - self.start_time
+        self.start_time = now
+
+        (self.histogram.labels(*labels) if labels else self.histogram).observe(elapsed)
+
+        return elapsed
+
+
+def get_statement_class(statement: str) -> str:
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return keyword if keyword in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER'
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_DURATION.labels(get_statement_class(statement)).observe(
+            time.perf_counter() - conn.info['query_start_time'].pop()
+        )
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        # failed statements do not reach after_cursor_execute
+        start_times = context.connection.info.get('query_start_time') if context.connection else None
+
+        if start_times:
+            start_times.pop()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing request duration by route template, so paths
+    with emails do not create a series per user.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+
+        finally:
+            route = scope.get('route')
+
+            HTTP_REQUEST_DURATION.labels(
+                scope['method'],
+                route.path if route is not None else 'unmatched',
+                str(status_code)
+            ).observe(time.perf_counter() - start_time)
@@ -1,4 +1,4 @@
-from sqlalchemy import Integer, String, DateTime, Boolean, UniqueConstraint
+from sqlalchemy import BigInteger, Integer, String, DateTime, Boolean, Index, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped
 from sqlalchemy.ext.asyncio import AsyncAttrs
@@ -22,14 +22,86 @@ class User(Base):
     cipher_type: Mapped[int] = mapped_column(Integer, nullable=True)
     uuid: Mapped[str] = mapped_column(String(36), nullable=True)
     flow: Mapped[str] = mapped_column(String(32), nullable=True)
+    node: Mapped[str] = mapped_column(String(64), nullable=True)
     traffic: Mapped[int] = mapped_column(Integer, default=0)
     online_sessions: Mapped[int] = mapped_column(Integer, default=0)
     limit: Mapped[int] = mapped_column(Integer)
+    max_ips: Mapped[int] = mapped_column(Integer, nullable=True)
+    suspended_until: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     is_blocked: Mapped[bool] = mapped_column(Boolean, default=False)
     created_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     reset_traffic_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # stamped on every change, see changes.py
+    version: Mapped[int] = mapped_column(BigInteger, nullable=True)
 
     __table_args__ = (
         UniqueConstraint('inbound_tag', 'uuid', 'email', name='uix__inbound_tag__uuid__email'),
+        Index('ix__users__version', 'version'),
+        Index('ix__users__inbound_tag__version', 'inbound_tag', 'version'),
+    )
+
+
+class UserTombstone(Base):
+    __tablename__ = 'user_tombstones'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    inbound_tag: Mapped[str] = mapped_column(String(64))
+    email: Mapped[str] = mapped_column(String(128))
+    version: Mapped[int] = mapped_column(BigInteger)
+    deleted_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('inbound_tag', 'email', name='uix__user_tombstones__inbound_tag__email'),
+        Index('ix__user_tombstones__version', 'version'),
+    )
+
+
+class TrafficHistory(Base):
+    __tablename__ = 'traffic_history'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    resolution: Mapped[int] = mapped_column(Integer)
+    bucket_date: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    inbound_tag: Mapped[str] = mapped_column(String(64))
+    # empty e-mail holds the inbound total
+    email: Mapped[str] = mapped_column(String(128), default='')
+    uplink: Mapped[int] = mapped_column(BigInteger, default=0)
+    downlink: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    __table_args__ = (
+        Index('ix__traffic_history__inbound_tag__email__bucket_date', 'inbound_tag', 'email', 'bucket_date'),
+        # one row per bucket, samples of the same bucket are added to it
+        Index(
+            'uix__traffic_history__resolution__bucket_date__inbound_tag__email',
+            'resolution', 'bucket_date', 'inbound_tag', 'email',
+            unique=True
+        ),
+    )
+
+
+class DaemonState(Base):
+    __tablename__ = 'daemon_state'
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    value: Mapped[int] = mapped_column(Integer)
+
+
+class XrayOperation(Base):
+    __tablename__ = 'xray_operations'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    inbound_tag: Mapped[str] = mapped_column(String(64))
+    email: Mapped[str] = mapped_column(String(128))
+    node: Mapped[str] = mapped_column(String(64), nullable=True)
+    action: Mapped[str] = mapped_column(String(16))
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    last_error: Mapped[str] = mapped_column(String(1024), nullable=True)
+    created_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    next_attempt_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('inbound_tag', 'email', name='uix__xray_operations__inbound_tag__email'),
+        Index('ix__xray_operations__next_attempt_date', 'next_attempt_date'),
     )
@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta
+from sqlalchemy import tuple_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from typing import Dict, Tuple
+
+import asyncio, random
+
+from crud import operations
+from loki_logger import LOGGER
+from provisioning import gather_bounded
+from schemas import OperationEnum, XrayError
+from xray_cluster import XrayCluster
+
+import models
+
+
+class XrayOutbox:
+    """
+    Applies add/remove operations stored in xray_operations, retrying failed
+    ones with exponential backoff until Xray accepts them.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker[AsyncSession],
+        xray: XrayCluster,
+        concurrency: int = 16,
+        batch_size: int = 100,
+        base_backoff: float = 1.0,
+        max_backoff: float = 300.0
+    ) -> None:
+        self.session_maker = session_maker
+        self.xray = xray
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.pending = 0
+        self.is_dirty = False
+        self.task: asyncio.Task | None = None
+
+    def schedule(self) -> None:
+        self.is_dirty = True
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def poll(self) -> None:
+        # scheduler jobs have to be coroutines, plain functions run in a thread without the event loop
+        self.schedule()
+
+    async def run(self) -> None:
+        while self.is_dirty:
+            self.is_dirty = False
+
+            try:
+                await self.drain()
+
+            except Exception as e:
+                LOGGER.error(
+                    'XRAY OPERATION ERROR',
+                    extra={
+                        'tags': {
+                            'error_type': type(e).__name__,
+                            'error_msg': str(e)
+                        }
+                    },
+                    exc_info=True,
+                )
+
+    async def apply(self, operation: models.XrayOperation, user: models.User | None) -> str | None:
+        names = self.xray.get_node_names(operation.inbound_tag, operation.node)
+
+        if operation.action == OperationEnum.add.value:
+            # user was deleted or deactivated after the operation had been queued
+            if user is None or not user.is_active:
+                return None
+
+            results = await self.xray.fan_out(names, lambda node: node.add_user(
+                inbound_tag=user.inbound_tag,
+                email=user.email,
+                level=user.level,
+                type=user.type,
+                password=user.password,
+                cipher_type=user.cipher_type,
+                uuid=user.uuid,
+                flow=user.flow,
+            ))
+            benign_error = 'already exists.'
+
+        else:
+            # user was recreated or activated again after the operation had been queued
+            if user is not None and user.is_active:
+                return None
+
+            results = await self.xray.fan_out(names, lambda node: node.remove_user(operation.inbound_tag, operation.email))
+            benign_error = 'not found.'
+
+        errors = [
+            f'{name}: {result.message}' for name, result in results.items()
+            if type(result) is XrayError and not result.message.endswith(benign_error)
+        ]
+
+        return '; '.join(errors) if errors else None
+
+    async def drain(self) -> None:
+        while True:
+            async with self.session_maker() as session:
+                operationsList = await operations.get_due_operations(session, datetime.now(), self.batch_size)
+
+                keys = {(operation.inbound_tag, operation.email) for operation in operationsList}
+                users: Dict[Tuple[str, str], models.User] = {}
+
+                if keys:
+                    result = await session.execute(select(models.User).filter(
+                        tuple_(models.User.inbound_tag, models.User.email).in_(keys)
+                    ))
+                    users = {(user.inbound_tag, user.email): user for user in result.scalars().all()}
+
+                errors: Dict[int, str | None] = {}
+
+                async def apply(operation: models.XrayOperation):
+                    errors[operation.id] = await self.apply(
+                        operation,
+                        users.get((operation.inbound_tag, operation.email))
+                    )
+
+                await gather_bounded(operationsList, apply, self.concurrency)
+
+                for operation in operationsList:
+                    error = errors[operation.id]
+
+                    if error is None:
+                        await operations.delete_operation(session, operation.id)
+                        continue
+
+                    delay = min(self.base_backoff * 2 ** operation.attempts, self.max_backoff)
+
+                    await operations.reschedule_operation(
+                        session,
+                        operation.id,
+                        operation.attempts + 1,
+                        datetime.now() + timedelta(seconds=delay * random.uniform(0.5, 1.5)),
+                        error
+                    )
+
+                    LOGGER.error(
+                        'XRAY OPERATION ERROR',
+                        extra={
+                            'tags': {
+                                'action': operation.action,
+                                'error_msg': error,
+                                'email': operation.email,
+                                'attempts': operation.attempts + 1
+                            }
+                        }
+                    )
+
+                await session.commit()
+
+                if len(operationsList) < self.batch_size:
+                    self.pending = await operations.count_operations(session)
+                    return
@@ -0,0 +1,111 @@
+from datetime import datetime
+from typing import Any, Dict
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import asyncio, time
+
+from provisioning import ProvisioningState
+from schemas import XrayError
+from xray_cluster import XrayCluster
+
+
+class HealthProbes:
+    """
+    Checks the database and every Xray node on a schedule and keeps the
+    results, so liveness and readiness requests are answered from memory
+    and never add load to the dependencies.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        xray: XrayCluster,
+        provisioning: ProvisioningState,
+        database_timeout: float = 2.0,
+        interval: float = 5.0,
+        max_cycle_age: float = 60.0,
+        max_live_cycle_age: float = 600.0
+    ) -> None:
+        self.session_maker = session_maker
+        self.xray = xray
+        self.provisioning = provisioning
+        self.database_timeout = database_timeout
+        self.interval = interval
+        self.max_cycle_age = max_cycle_age
+        self.max_live_cycle_age = max_live_cycle_age
+
+        self.started_time = time.monotonic()
+        self.checked_time: float | None = None
+        self.checked_date: datetime | None = None
+        self.cycles = 0
+        self.last_cycle_time: float | None = None
+        self.last_cycle_date: datetime | None = None
+
+        self.database: Dict[str, Any] = {'is_ok': False, 'latency_ms': None, 'error': 'not checked'}
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+
+    def record_cycle(self) -> None:
+        self.cycles += 1
+        self.last_cycle_time = time.monotonic()
+        self.last_cycle_date = datetime.now().replace(microsecond=0)
+
+    async def probe_database(self) -> Dict[str, Any]:
+        start_time = time.monotonic()
+
+        try:
+            async with self.session_maker() as session:
+                await asyncio.wait_for(session.execute(text('SELECT 1')), self.database_timeout)
+
+        except Exception as e:
+            return {'is_ok': False, 'latency_ms': None, 'error': f'{type(e).__name__}: {e}'}
+
+        return {'is_ok': True, 'latency_ms': round((time.monotonic() - start_time) * 1000, 3), 'error': None}
+
+    async def probe_node(self, name: str) -> Dict[str, Any]:
+        node = self.xray.nodes[name]
+        start_time = time.monotonic()
+
+        # an open breaker answers without a call, the probe reports it as is
+        uptime = await node.get_uptime()
+        latency_ms = round((time.monotonic() - start_time) * 1000, 3)
+
+        if type(uptime) is XrayError:
+            return {'is_ok': False, 'latency_ms': None, 'error': uptime.message, 'circuit': node.breaker.snapshot()}
+
+        return {'is_ok': True, 'latency_ms': latency_ms, 'error': None, 'circuit': node.breaker.snapshot()}
+
+    async def probe(self) -> None:
+        database, *nodes = await asyncio.gather(
+            self.probe_database(),
+            *(self.probe_node(name) for name in self.xray.nodes)
+        )
+
+        self.database = database
+        self.nodes = dict(zip(self.xray.nodes, nodes))
+        self.checked_time = time.monotonic()
+        self.checked_date = datetime.now().replace(microsecond=0)
+
+    def get_probe_age(self) -> float | None:
+        return round(time.monotonic() - self.checked_time, 3) if self.checked_time is not None else None
+
+    def get_cycle_age(self) -> float:
+        # before the first cycle the age is counted from the start of the daemon
+        return round(time.monotonic() - (self.last_cycle_time or self.started_time), 3)
+
+    def is_fresh(self) -> bool:
+        probe_age = self.get_probe_age()
+        return probe_age is not None and probe_age <= self.interval * 3
+
+    def is_alive(self) -> bool:
+        # dependencies are not part of liveness, a restart does not fix them
+        return self.is_fresh() and self.get_cycle_age() <= self.max_live_cycle_age
+
+    def is_ready(self) -> bool:
+        return (
+            self.is_fresh() and
+            self.database['is_ok'] and
+            any(node['is_ok'] for node in self.nodes.values()) and
+            self.provisioning.is_ready and
+            self.get_cycle_age() <= self.max_cycle_age
+        )
@@ -2,30 +2,120 @@ from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from sqlalchemy.exc import SQLAlchemyError
 
-import os
-
-from database import XRAY_INSTANCE, SessionLocal
+import asyncio, functools, os, time
+
+from database import (
+    HEALTH_PROBES,
+    IP_LIMITER,
+    LEADERBOARDS,
+    QUOTA_GUARD,
+    RATE_TRACKER,
+    TRAFFIC_JOURNAL,
+    WEBHOOKS,
+    XRAY_CONFIG_SNAPSHOT,
+    XRAY_INSTANCE,
+    XRAY_OUTBOX,
+    SessionLocal
+)
 from loki_logger import LOGGER
+from metrics import (
+    PROCESSING_CHANGES,
+    PROCESSING_DURATION,
+    PROCESSING_ERRORS,
+    PROCESSING_LAST_SUCCESS,
+    PROCESSING_PHASE_DURATION,
+    PROCESSING_USERS,
+    Timer
+)
+from tracing import TRACER
+from provisioning import gather_bounded
 from schemas import XrayError
-from crud import users
+from crud import history, operations, state, users
 
 import schemas
 
 
 load_dotenv('../.env')
 
+# the cycle and the hot checks both drain counters and commit the journal
+PROCESSING_LOCK = asyncio.Lock()
+
+QUOTA_CONCURRENCY = int(os.getenv('QUOTA_CONCURRENCY', 16))
+ONLINE_CONCURRENCY = int(os.getenv('ONLINE_CONCURRENCY', 32))
+IP_LIMIT_COOLDOWN_SECONDS = float(os.getenv('IP_LIMIT_COOLDOWN_SECONDS', 300))
+
+def exclusive(func):
+    @functools.wraps(func)
+    async def wrapper():
+        async with PROCESSING_LOCK:
+            return await func()
+
+    return wrapper
+
+@TRACER.traced('process')
+@exclusive
 async def process():
     inactivated_users = []
     activated_users = []
     blocked_users = []
+    suspended_users = []
+
+    # webhook events are emitted only once the cycle is committed
+    events = []
+
+    cycle_timer = Timer(PROCESSING_DURATION)
+    phase_timer = Timer(PROCESSING_PHASE_DURATION)
 
     async with SessionLocal() as session:
         try:
             usersList, _ = await users.get_users(session)
+            TRACER.record('load', phase_timer.observe('load'))
 
             now = datetime.now().replace(microsecond=0)
             reset_traffic_period = float(os.getenv("RESET_TRAFFIC_PERIOD_SECONDS"))
 
+            # drain counters of all users and journal them before anything else can fail
+            traffic, errors = await XRAY_INSTANCE.get_users_traffic(reset=True)
+            traffic = await TRAFFIC_JOURNAL.append(traffic)
+            sample_time = time.monotonic()
+            TRACER.record('drain', phase_timer.observe('drain'))
+
+            for node, error in errors.items():
+                LOGGER.error(
+                    'TRAFFIC ERROR',
+                    extra={
+                        'tags': {
+                            'node': node,
+                            'error_msg': error.message
+                        }
+                    }
+                )
+
+            online = {}
+
+            async def get_online(user):
+                online_sessions = await XRAY_INSTANCE.get_user_online_sessions(user.email)
+                online[user.email] = online_sessions if not type(online_sessions) is XrayError else 0
+
+            await gather_bounded(usersList, get_online, ONLINE_CONCURRENCY)
+
+            # only users over max_ips by the online count are verified by their IP list
+            ip_limit_candidates = [
+                (user.email, user.max_ips, online[user.email])
+                for user in usersList
+                if (
+                    user.max_ips and
+                    user.is_active and
+                    online[user.email] > user.max_ips and
+                    not (user.suspended_until and user.suspended_until > now)
+                )
+            ]
+            violations = await IP_LIMITER.get_violations(ip_limit_candidates)
+            IP_LIMITER.retain(email for email, _, _ in ip_limit_candidates)
+
+            history_traffic = {}
+            LEADERBOARDS.begin()
+
             for user in usersList:
                 user_data = schemas.UpdateUser(
                     traffic=user.traffic,
@@ -37,20 +127,40 @@ async def process():
 
                 is_need_to_reset = user_data.reset_traffic_date + timedelta(seconds=reset_traffic_period) <= now or user_data.traffic == -1
 
-                download_traffic = await XRAY_INSTANCE.get_user_download_traffic(user.email, is_need_to_reset)
-                upload_traffic = await XRAY_INSTANCE.get_user_upload_traffic(user.email, is_need_to_reset)
-                online_sessions = await XRAY_INSTANCE.get_user_online_sessions(user.email)
+                upload_traffic, download_traffic = traffic.get(user.email, (0, 0))
+                history_traffic[(user.inbound_tag, user.email)] = [upload_traffic, download_traffic]
+                RATE_TRACKER.observe(user.inbound_tag, user.email, upload_traffic, download_traffic, sample_time)
+                is_suspended = user.suspended_until is not None and user.suspended_until > now
 
                 if is_need_to_reset == False:
+                    # counters were not drained before the journal existed, they hold the period total
                     user_data.traffic = (
-                        download_traffic if not type(download_traffic) is XrayError else 0 +
-                        upload_traffic if not type(upload_traffic) is XrayError else 0
+                        (user_data.traffic if TRAFFIC_JOURNAL.is_initialized else 0) +
+                        upload_traffic + download_traffic
                     )
 
                 else:
                     user_data.traffic = 0
 
-                user_data.online_sessions = online_sessions if not type(online_sessions) is XrayError else 0
+                user_data.online_sessions = online[user.email]
+
+                # connected from more addresses than allowed, removed from Xray until the cooldown ends
+                if user.email in violations:
+                    is_suspended = True
+                    user_data.suspended_until = now + timedelta(seconds=IP_LIMIT_COOLDOWN_SECONDS)
+                    suspended_users.append(user.email)
+
+                    LOGGER.warning(
+                        'USER SUSPENDED',
+                        extra={
+                            'tags': {
+                                'email': user.email,
+                                'max_ips': user.max_ips,
+                                'ips': ', '.join(violations[user.email]),
+                                'suspended_until': user_data.suspended_until.isoformat()
+                            }
+                        }
+                    )
 
                 # compare traffic and limit then set inactive due traffic overage
                 is_traffic_overage = (
@@ -68,33 +178,14 @@ async def process():
                 if is_need_to_reset:
                     if (
                         user_data.is_active == False and
-                        user_data.is_blocked == False
+                        user_data.is_blocked == False and
+                        is_suspended == False
                     ):
                         user_data.is_active = True
 
                     user_data.traffic = 0
                     user_data.reset_traffic_date = now
 
-                    if (
-                        type(is_need_to_reset) is XrayError or
-                        type(upload_traffic) is XrayError
-                    ):
-                        error_msg = []
-
-                        error_msg.append(is_need_to_reset.message if type(is_need_to_reset) is XrayError else '')
-                        error_msg.append(upload_traffic.message if type(upload_traffic) is XrayError else '')
-
-                        LOGGER.error(
-                            'RESET TRAFFIC ERROR',
-                            extra={
-                                'tags': {
-                                    'error_msg': '\n'.join(error_msg),
-                                    'email': user.email
-                                }
-                            },
-                            exc_info=True,
-                        )
-
                 # inactivate previously blocked user
                 if (
                     user_data.is_active == True and
@@ -103,11 +194,19 @@ async def process():
                     blocked_users.append(user.email)
                     user_data.is_active = False
 
-                # activate previously unblocked user
+                # inactivate suspended user
+                if (
+                    user_data.is_active == True and
+                    is_suspended == True
+                ):
+                    user_data.is_active = False
+
+                # activate previously unblocked user after the suspension
                 if (
                     user_data.is_active == False and
                     user_data.is_blocked == False and
-                    is_traffic_overage == False
+                    is_traffic_overage == False and
+                    is_suspended == False
                 ):
                     user_data.is_active = True
 
@@ -116,59 +215,100 @@ async def process():
                     user_data.is_active == False and
                     user.is_active == True
                 ):
-                    result = await XRAY_INSTANCE.remove_user(user.inbound_tag, user.email)
-
-                    if type(result) is XrayError:
-                        LOGGER.error(
-                            'REMOVE USER ERROR',
-                            extra={
-                                'tags': {
-                                    'error_msg': result.message,
-                                    'email': user.email
-                                }
-                            },
-                                exc_info=True,
-                        )
-                    else:
-                        inactivated_users.append(user.email)
+                    await operations.enqueue_operation(
+                        session,
+                        user.inbound_tag,
+                        user.email,
+                        user.node,
+                        schemas.OperationEnum.remove
+                    )
+                    inactivated_users.append(user.email)
+
+                    events.append(('user.deactivated', user.inbound_tag, user.email, {
+                        'reason': 'suspended' if is_suspended else 'blocked' if user_data.is_blocked else 'traffic_overage',
+                        'traffic': user_data.traffic,
+                        'limit': user_data.limit,
+                        'suspended_until': user_data.suspended_until.isoformat() if user_data.suspended_until else None
+                    }))
 
                 # add user
                 elif (
                     user_data.is_active == True and
                     user.is_active == False
                 ):
-                    user_data.traffic = 0
-                    user_data.reset_traffic_date = now
-
-                    result = await XRAY_INSTANCE.add_user(
-                        inbound_tag=user.inbound_tag,
-                        email=user.email,
-                        level=user.level,
-                        type=user.type,
-                        password=user.password,
-                        cipher_type=user.cipher_type,
-                        uuid=user.uuid,
-                        flow=user.flow,
+                    # a suspension which ended within the period keeps its traffic
+                    if not (
+                        user.suspended_until is not None and
+                        user.suspended_until > user_data.reset_traffic_date
+                    ):
+                        user_data.traffic = 0
+                        user_data.reset_traffic_date = now
+
+                    await operations.enqueue_operation(
+                        session,
+                        user.inbound_tag,
+                        user.email,
+                        user.node,
+                        schemas.OperationEnum.add
                     )
+                    activated_users.append(user.email)
+
+                    events.append(('user.activated', user.inbound_tag, user.email, {
+                        'reason': 'traffic_reset' if is_need_to_reset else 'restored',
+                        'traffic': user_data.traffic,
+                        'limit': user_data.limit
+                    }))
+
+                QUOTA_GUARD.update(
+                    user.inbound_tag,
+                    user.email,
+                    user_data.traffic,
+                    user_data.limit,
+                    user_data.is_active,
+                    sample_time
+                )
 
-                    if type(result) is XrayError:
-                        LOGGER.error(
-                            'ADD USER ERROR',
-                            extra={
-                                'tags': {
-                                    'error_msg': result.message,
-                                    'email': user.email
-                                }
-                            },
-                            exc_info=True,
-                        )
-                    else:
-                        activated_users.append(user.email)
+                series = RATE_TRACKER.series.get(user.email)
+                LEADERBOARDS.add(
+                    user.inbound_tag,
+                    user.email,
+                    user_data.traffic,
+                    user_data.online_sessions,
+                    series.upload_rate if series else 0.0,
+                    series.download_rate if series else 0.0
+                )
+
+                # unchanged rows keep their version, so the change feed returns only what changed
+                if all(
+                    getattr(user, field) == value
+                    for field, value in user_data.model_dump(exclude_unset=True, exclude_none=True).items()
+                ):
+                    continue
 
-                await users.update_user(session, user.inbound_tag, user.email, user_data)
+                # Xray operation is committed together with the new state
+                await users.update_user(session, user.inbound_tag, user.email, user_data, commit=False)
+
+            RATE_TRACKER.retain(user.email for user in usersList)
+            TRACER.record('evaluate', phase_timer.observe('evaluate'))
+
+            await history.add_samples(session, now, history_traffic)
+            await state.set_state(session, TRAFFIC_JOURNAL.STATE_KEY, TRAFFIC_JOURNAL.last_batch_id)
+            await session.commit()
+
+            TRAFFIC_JOURNAL.commit()
+            LEADERBOARDS.commit()
+
+            for event_type, inbound_tag, email, data in events:
+                WEBHOOKS.emit(event_type, inbound_tag, email, **data)
+            TRACER.record('commit', phase_timer.observe('commit'))
+
+            PROCESSING_USERS.set(len(usersList))
+            PROCESSING_LAST_SUCCESS.set(time.time())
+            HEALTH_PROBES.record_cycle()
 
         except SQLAlchemyError as e:
             await session.rollback()
+            PROCESSING_ERRORS.inc()
 
             LOGGER.error(
                 'PROCESSING ERROR (SQL)',
@@ -183,6 +323,7 @@ async def process():
 
         except Exception as e:
             await session.rollback()
+            PROCESSING_ERRORS.inc()
 
             LOGGER.error(
                 'PROCESSING ERROR',
@@ -198,13 +339,164 @@ async def process():
         finally:
             await session.close()
 
+        cycle_timer.observe()
+
+        PROCESSING_CHANGES.labels('inactivated').inc(len(inactivated_users))
+        PROCESSING_CHANGES.labels('activated').inc(len(activated_users))
+        PROCESSING_CHANGES.labels('blocked').inc(len(blocked_users))
+
+        if inactivated_users or activated_users or blocked_users or suspended_users:
+            XRAY_OUTBOX.schedule()
+            XRAY_CONFIG_SNAPSHOT.schedule()
+
         LOGGER.info(
             'PROCESSING RESULT',
             extra={
                 'tags': {
                     'inactivated_users': ', '.join(inactivated_users),
                     'activated_users': ', '.join(activated_users),
-                    'blocked_users': ', '.join(blocked_users)
+                    'blocked_users': ', '.join(blocked_users),
+                    'suspended_users': ', '.join(suspended_users)
+                }
+            }
+        )
+
+
+async def enforce_quotas():
+    """
+    Drain and check only users of the hot set which are due, the cycle
+    keeps handling everyone else.
+    """
+    # counters were not drained before the journal existed, the first cycle has to run before
+    if not TRAFFIC_JOURNAL.is_initialized or not QUOTA_GUARD.has_due(time.monotonic()) or PROCESSING_LOCK.locked():
+        return
+
+    async with PROCESSING_LOCK:
+        keys = QUOTA_GUARD.pop_due(time.monotonic())
+        inactivated_users = []
+        events = []
+
+        if not keys:
+            return
+
+        # batches of a failed cycle are applied by the next cycle, committing here would skip them on replay
+        if TRAFFIC_JOURNAL.pending:
+            QUOTA_GUARD.retry(keys, time.monotonic())
+            return
+
+        async with SessionLocal() as session:
+            try:
+                usersList, _ = await users.get_users(session, emails=list({email for _, email in keys}))
+                reset_traffic_period = float(os.getenv("RESET_TRAFFIC_PERIOD_SECONDS"))
+                reset_date = datetime.now().replace(microsecond=0) - timedelta(seconds=reset_traffic_period)
+
+                # a traffic reset is due for these, the same as in the cycle, so their counters are left to it
+                emails = {user.email for user in usersList} - {
+                    user.email for user in usersList
+                    if user.traffic < 0 or user.reset_traffic_date <= reset_date
+                }
+                usersList = [user for user in usersList if user.email in emails]
+
+                drained = {}
+
+                async def drain(email):
+                    upload_traffic = await XRAY_INSTANCE.get_user_upload_traffic(email, reset=True)
+                    download_traffic = await XRAY_INSTANCE.get_user_download_traffic(email, reset=True)
+
+                    drained[email] = [
+                        upload_traffic if not type(upload_traffic) is XrayError else 0,
+                        download_traffic if not type(download_traffic) is XrayError else 0
+                    ]
+
+                await gather_bounded(emails, drain, QUOTA_CONCURRENCY)
+
+                await TRAFFIC_JOURNAL.append(drained)
+                sample_time = time.monotonic()
+                now = datetime.now().replace(microsecond=0)
+
+                history_traffic = {}
+
+                for user in usersList:
+                    upload_traffic, download_traffic = drained[user.email]
+                    history_traffic[(user.inbound_tag, user.email)] = [upload_traffic, download_traffic]
+
+                    if (user.inbound_tag, user.email) in keys:
+                        RATE_TRACKER.observe(user.inbound_tag, user.email, upload_traffic, download_traffic, sample_time)
+
+                    user_data = schemas.UpdateUser(
+                        traffic=user.traffic + upload_traffic + download_traffic,
+                        is_active=user.is_active
+                    )
+
+                    if (
+                        user_data.is_active == True and
+                        user.limit != 0 and
+                        user_data.traffic > user.limit
+                    ):
+                        user_data.is_active = False
+
+                        await operations.enqueue_operation(
+                            session,
+                            user.inbound_tag,
+                            user.email,
+                            user.node,
+                            schemas.OperationEnum.remove
+                        )
+                        inactivated_users.append(user.email)
+                        events.append(('user.deactivated', user.inbound_tag, user.email, {
+                            'reason': 'traffic_overage',
+                            'traffic': user_data.traffic,
+                            'limit': user.limit
+                        }))
+
+                    await users.update_user(session, user.inbound_tag, user.email, user_data, commit=False)
+
+                    QUOTA_GUARD.update(
+                        user.inbound_tag,
+                        user.email,
+                        user_data.traffic,
+                        user.limit,
+                        user_data.is_active,
+                        sample_time
+                    )
+
+                await history.add_samples(session, now, history_traffic)
+                await state.set_state(session, TRAFFIC_JOURNAL.STATE_KEY, TRAFFIC_JOURNAL.last_batch_id)
+                await session.commit()
+
+                TRAFFIC_JOURNAL.commit()
+
+                for event_type, inbound_tag, email, data in events:
+                    WEBHOOKS.emit(event_type, inbound_tag, email, **data)
+
+            except Exception as e:
+                await session.rollback()
+                inactivated_users = []
+
+                # drained traffic stays in the journal for the next cycle
+                QUOTA_GUARD.retry(keys, time.monotonic())
+
+                LOGGER.error(
+                    'QUOTA ERROR',
+                    extra={
+                        'tags': {
+                            'error_type': type(e).__name__,
+                            'error_msg': str(e)
+                        }
+                    },
+                    exc_info=True,
+                )
+
+        if inactivated_users:
+            XRAY_OUTBOX.schedule()
+            XRAY_CONFIG_SNAPSHOT.schedule()
+
+        LOGGER.info(
+            'QUOTA RESULT',
+            extra={
+                'tags': {
+                    'checked_users': len(keys),
+                    'inactivated_users': ', '.join(inactivated_users)
                 }
             }
         )
@@ -0,0 +1,146 @@
+from collections import Counter
+from datetime import datetime
+from typing import Awaitable, Callable
+
+import asyncio, cProfile, functools, io, os, pstats, sys, threading, time
+
+from loki_logger import LOGGER
+from schemas import ProfileModeEnum, ProfileTargetEnum
+
+
+def collapse_stack(frame) -> str:
+    # root first, in the folded format of flamegraph.pl and speedscope
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """
+    Profiles the next processing cycles or a time window of the event loop
+    on demand. Everything running on the loop meanwhile is profiled too,
+    the event loop has a single thread.
+    """
+
+    def __init__(self, sample_interval: float = 0.005, limit: int = 80) -> None:
+        self.sample_interval = sample_interval
+        self.limit = limit
+
+        self.target: ProfileTargetEnum | None = None
+        self.mode: ProfileModeEnum | None = None
+        self.runs_left = 0
+        self.started_date: datetime | None = None
+        self.finished_date: datetime | None = None
+        self.result: str | None = None
+
+        self.profile: cProfile.Profile | None = None
+        self.samples: Counter = Counter()
+        self.sampler: threading.Thread | None = None
+        self.is_sampling = False
+        self.loop_thread_id: int | None = None
+
+    @property
+    def is_armed(self) -> bool:
+        return self.target is not None and self.finished_date is None
+
+    def arm(self, target: ProfileTargetEnum, mode: ProfileModeEnum, runs: int = 1, seconds: float = 30) -> None:
+        if self.is_armed:
+            raise RuntimeError('Profiler is already armed')
+
+        self.target = target
+        self.mode = mode
+        self.runs_left = runs if target == ProfileTargetEnum.process else 0
+        self.started_date = datetime.now().replace(microsecond=0)
+        self.finished_date = None
+        self.result = None
+
+        self.profile = cProfile.Profile() if mode == ProfileModeEnum.cprofile else None
+        self.samples = Counter()
+        self.loop_thread_id = threading.get_ident()
+
+        if target == ProfileTargetEnum.api:
+            self.start()
+            asyncio.get_running_loop().call_later(seconds, self.finish)
+
+    def start(self) -> None:
+        if self.mode == ProfileModeEnum.cprofile:
+            self.profile.enable()
+            return
+
+        self.is_sampling = True
+        self.sampler = threading.Thread(target=self.sample, name='profiler', daemon=True)
+        self.sampler.start()
+
+    def stop(self) -> None:
+        if self.mode == ProfileModeEnum.cprofile:
+            self.profile.disable()
+            return
+
+        self.is_sampling = False
+        self.sampler.join()
+
+    def sample(self) -> None:
+        while self.is_sampling:
+            frame = sys._current_frames().get(self.loop_thread_id)
+
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+
+            time.sleep(self.sample_interval)
+
+    def finish(self) -> None:
+        if not self.is_armed:
+            return
+
+        if self.target == ProfileTargetEnum.api:
+            self.stop()
+
+        if self.mode == ProfileModeEnum.cprofile:
+            stream = io.StringIO()
+            pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(self.limit)
+            self.result = stream.getvalue()
+
+        else:
+            self.result = '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
+
+        self.finished_date = datetime.now().replace(microsecond=0)
+        self.profile = None
+        self.samples = Counter()
+
+        LOGGER.info(
+            'PROFILE FINISHED',
+            extra={
+                'tags': {
+                    'target': self.target.value,
+                    'mode': self.mode.value,
+                    'duration_s': (self.finished_date - self.started_date).total_seconds()
+                }
+            }
+        )
+
+    def wrap(self, func: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+        @functools.wraps(func)
+        async def wrapper() -> None:
+            if not (self.is_armed and self.target == ProfileTargetEnum.process and self.runs_left > 0):
+                return await func()
+
+            self.start()
+
+            try:
+                await func()
+
+            finally:
+                self.stop()
+                self.runs_left -= 1
+
+                if self.runs_left == 0:
+                    self.finish()
+
+        return wrapper
+
+PROFILER = Profiler()
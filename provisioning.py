@@ -0,0 +1,236 @@
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+import asyncio, time
+
+from loki_logger import LOGGER
+from schemas import XrayError
+from xray_cluster import XrayCluster
+
+import models
+
+
+async def gather_bounded(items: Iterable[Any], worker: Callable[[Any], Awaitable[None]], concurrency: int) -> None:
+    # fixed number of workers share one iterator, so memory does not grow with the number of items
+    iterator = iter(items)
+
+    async def run():
+        for item in iterator:
+            await worker(item)
+
+    await asyncio.gather(*(run() for _ in range(max(concurrency, 1))))
+
+
+class ProvisioningState:
+    def __init__(self) -> None:
+        self.total = 0
+        self.done = 0
+        self.added = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started_date: datetime | None = None
+        self.finished_date: datetime | None = None
+        self.is_ready = False
+        self.task: asyncio.Task | None = None
+
+    def reset(self, total: int) -> None:
+        self.total = total
+        self.done = self.added = self.skipped = self.failed = 0
+        self.started_date = datetime.now().replace(microsecond=0)
+        self.finished_date = None
+
+PROVISIONING = ProvisioningState()
+
+async def provision_users(
+    xray: XrayCluster,
+    usersList: List[models.User],
+    concurrency: int = 64,
+    node_names: List[str] = None,
+    state: ProvisioningState = None,
+    reason: str = 'startup'
+) -> ProvisioningState:
+    node_names = node_names or list(xray.nodes)
+    state = state or ProvisioningState()
+    state.reset(len(usersList))
+
+    # counters only order the work, users without them are most likely missing and are added first.
+    # Xray keeps counters after a user is removed, so every user still gets an add and is skipped only on an `already exists` answer
+    present = {
+        name: emails if not type(emails) is XrayError else set()
+        for name, emails in (await xray.get_user_emails(node_names)).items()
+    }
+
+    usersList = sorted(
+        usersList,
+        key=lambda user: all(
+            user.email in present.get(name, ())
+            for name in xray.get_node_names(user.inbound_tag, user.node)
+        )
+    )
+
+    start_time = time.monotonic()
+    last_log_time = start_time
+
+    async def provision(user: models.User):
+        nonlocal last_log_time
+
+        names = [
+            name for name in xray.get_node_names(user.inbound_tag, user.node)
+            if name in node_names
+        ]
+
+        if not names:
+            state.skipped += 1
+
+        else:
+            results = await asyncio.gather(*(
+                xray.nodes[name].add_user(
+                    inbound_tag=user.inbound_tag,
+                    email=user.email,
+                    level=user.level,
+                    type=user.type,
+                    password=user.password,
+                    cipher_type=user.cipher_type,
+                    uuid=user.uuid,
+                    flow=user.flow,
+                )
+                for name in names
+            ))
+
+            errors = [
+                result for result in results
+                if type(result) is XrayError and not result.message.endswith('already exists.')
+            ]
+
+            if errors:
+                state.failed += 1
+
+                LOGGER.error(
+                    'XRAY ERROR',
+                    extra={
+                        'tags': {
+                            'error_msg': '\n'.join(error.message for error in errors),
+                            'user.email': user.email
+                        }
+                    },
+                    exc_info=True,
+                )
+
+            elif None in results:
+                state.added += 1
+
+            else:
+                state.skipped += 1
+
+        state.done += 1
+
+        if time.monotonic() - last_log_time >= 5:
+            last_log_time = time.monotonic()
+
+            LOGGER.info(
+                'PROVISIONING PROGRESS',
+                extra={
+                    'tags': {
+                        'reason': reason,
+                        'done': state.done,
+                        'total': state.total,
+                        'users_per_second': round(state.done / (last_log_time - start_time), 1)
+                    }
+                }
+            )
+
+    await gather_bounded(usersList, provision, concurrency)
+
+    duration = time.monotonic() - start_time
+    state.finished_date = datetime.now().replace(microsecond=0)
+
+    LOGGER.info(
+        'PROVISIONING RESULT',
+        extra={
+            'tags': {
+                'reason': reason,
+                'nodes': ', '.join(node_names),
+                'total': state.total,
+                'added': state.added,
+                'skipped': state.skipped,
+                'failed': state.failed,
+                'duration_ms': round(duration * 1000),
+                'users_per_second': round(state.total / duration, 1) if duration > 0 else state.total
+            }
+        }
+    )
+
+    return state
+
+
+class RestartWatcher:
+    """
+    Polls uptime of every node and provisions active users again when it
+    drops, so a crashed core gets its users back without a daemon restart.
+    """
+
+    def __init__(
+        self,
+        xray: XrayCluster,
+        load_users: Callable[[], Awaitable[List[models.User]]],
+        concurrency: int = 64
+    ) -> None:
+        self.xray = xray
+        self.load_users = load_users
+        self.concurrency = concurrency
+
+        self.uptimes: Dict[str, int] = {}
+        self.restarts: Dict[str, int] = {name: 0 for name in xray.nodes}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    async def check(self) -> None:
+        uptimes = await self.xray.fan_out(list(self.xray.nodes), lambda node: node.get_uptime())
+
+        for name, uptime in uptimes.items():
+            if type(uptime) is XrayError:
+                continue
+
+            last_uptime = self.uptimes.get(name)
+            self.uptimes[name] = uptime
+
+            if last_uptime is None or uptime >= last_uptime:
+                continue
+
+            self.restarts[name] += 1
+
+            LOGGER.warning(
+                'XRAY RESTART DETECTED',
+                extra={
+                    'tags': {
+                        'node': name,
+                        'uptime': uptime,
+                        'last_uptime': last_uptime
+                    }
+                }
+            )
+
+            if name not in self.tasks or self.tasks[name].done():
+                self.tasks[name] = asyncio.create_task(self.provision(name))
+
+    async def provision(self, name: str) -> None:
+        try:
+            await provision_users(
+                self.xray,
+                await self.load_users(),
+                self.concurrency,
+                node_names=[name],
+                reason='restart'
+            )
+
+        except Exception as e:
+            LOGGER.error(
+                'PROVISIONING ERROR',
+                extra={
+                    'tags': {
+                        'node': name,
+                        'error_type': type(e).__name__,
+                        'error_msg': str(e)
+                    }
+                },
+                exc_info=True,
+            )
@@ -0,0 +1,75 @@
+from typing import Dict, List, Tuple
+
+import heapq
+
+from rates import RateTracker
+
+
+class QuotaGuard:
+    """
+    Keeps users who may cross their limit before the next cycle in a hot
+    set. Each of them is checked again at the projected crossing time, so
+    the overshoot is bounded without polling every user faster.
+    """
+
+    def __init__(
+        self,
+        rates: RateTracker,
+        cycle_interval: float = 20.0,
+        min_interval: float = 1.0,
+        horizon: float = 2.0
+    ) -> None:
+        self.rates = rates
+        self.cycle_interval = cycle_interval
+        self.min_interval = min_interval
+
+        # users projected to cross within horizon cycles are hot
+        self.horizon = horizon
+
+        self.heap: List[Tuple[float, str, str]] = []
+        self.due: Dict[Tuple[str, str], float] = {}
+
+    def update(self, inbound_tag: str, email: str, traffic: int, limit: int, is_active: bool, now: float) -> None:
+        key = (inbound_tag, email)
+        rate = self.rates.get_projection_rate(email)
+
+        if not is_active or not limit or traffic < 0 or rate <= 0:
+            self.due.pop(key, None)
+            return
+
+        # time left until the limit at the current rate
+        eta = max(limit - traffic, 0) / rate
+
+        if eta > self.cycle_interval * self.horizon:
+            self.due.pop(key, None)
+            return
+
+        # halving the interval on every check converges on the crossing, a hot user is checked at least once between cycles
+        due = now + min(max(eta / 2, self.min_interval), self.cycle_interval / 2)
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, inbound_tag, email))
+
+    def retry(self, keys: List[Tuple[str, str]], now: float) -> None:
+        for inbound_tag, email in keys:
+            due = now + self.min_interval
+            self.due[(inbound_tag, email)] = due
+            heapq.heappush(self.heap, (due, inbound_tag, email))
+
+    def has_due(self, now: float) -> bool:
+        return bool(self.heap) and self.heap[0][0] <= now
+
+    def pop_due(self, now: float) -> List[Tuple[str, str]]:
+        keys = []
+
+        while self.heap and self.heap[0][0] <= now:
+            due, inbound_tag, email = heapq.heappop(self.heap)
+            key = (inbound_tag, email)
+
+            # entries replaced by a later update are skipped
+            if self.due.get(key) != due:
+                continue
+
+            del self.due[key]
+            keys.append(key)
+
+        return keys
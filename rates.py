@@ -0,0 +1,124 @@
+from array import array
+from typing import Dict, Iterable, List
+
+import math
+
+
+class RateSeries:
+    """
+    Ring buffer of the last samples of one user in typed arrays, about
+    24 bytes per sample instead of a tuple of Python objects.
+    """
+
+    __slots__ = ('inbound_tag', 'times', 'uplinks', 'downlinks', 'head', 'count', 'upload_rate', 'download_rate', 'last_rate')
+
+    def __init__(self, inbound_tag: str, capacity: int) -> None:
+        self.inbound_tag = inbound_tag
+        self.times = array('d', bytes(8 * capacity))
+        self.uplinks = array('Q', bytes(8 * capacity))
+        self.downlinks = array('Q', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+
+        # EWMA in bytes per second
+        self.upload_rate = 0.0
+        self.download_rate = 0.0
+
+        # total rate of the last interval alone, the EWMA lags behind a burst
+        self.last_rate = 0.0
+
+    def append(self, now: float, uplink: int, downlink: int) -> None:
+        self.times[self.head] = now
+        self.uplinks[self.head] = uplink
+        self.downlinks[self.head] = downlink
+
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def get_last_time(self) -> float | None:
+        return self.times[self.head - 1] if self.count else None
+
+    def get_current_rates(self) -> List[float]:
+        # traffic of the buffered samples over the time they span, the oldest one only marks the start
+        if self.count < 2:
+            return [0.0, 0.0]
+
+        capacity = len(self.times)
+        oldest = (self.head - self.count) % capacity
+        elapsed = self.times[self.head - 1] - self.times[oldest]
+
+        if elapsed <= 0:
+            return [0.0, 0.0]
+
+        indexes = [(oldest + offset) % capacity for offset in range(1, self.count)]
+
+        return [
+            sum(self.uplinks[index] for index in indexes) / elapsed,
+            sum(self.downlinks[index] for index in indexes) / elapsed
+        ]
+
+
+class RateTracker:
+    """
+    Estimates throughput of every user from the traffic drained between
+    samples, smoothed with a time-based EWMA so irregular sample intervals
+    (cycles and hot checks) are weighted by their length.
+    """
+
+    def __init__(self, half_life: float = 60.0, capacity: int = 16) -> None:
+        self.half_life = half_life
+        self.capacity = max(capacity, 2)
+
+        self.series: Dict[str, RateSeries] = {}
+
+    def observe(self, inbound_tag: str, email: str, uplink: int, downlink: int, now: float) -> float:
+        series = self.series.get(email)
+
+        if series is None:
+            series = self.series[email] = RateSeries(inbound_tag, self.capacity)
+
+        last_time = series.get_last_time()
+        series.inbound_tag = inbound_tag
+        series.append(now, uplink, downlink)
+
+        # the first sample has no interval, traffic before it is unknown
+        if last_time is not None and now > last_time:
+            elapsed = now - last_time
+            weight = 1 - math.exp(-elapsed * math.log(2) / self.half_life)
+
+            series.upload_rate += weight * (uplink / elapsed - series.upload_rate)
+            series.download_rate += weight * (downlink / elapsed - series.download_rate)
+            series.last_rate = (uplink + downlink) / elapsed
+
+        return series.upload_rate + series.download_rate
+
+    def get_rate(self, email: str) -> float:
+        series = self.series.get(email)
+        return series.upload_rate + series.download_rate if series else 0.0
+
+    def get_projection_rate(self, email: str) -> float:
+        # a burst is projected at its own rate, a pause does not hide a sustained one
+        series = self.series.get(email)
+        return max(series.upload_rate + series.download_rate, series.last_rate) if series else 0.0
+
+    def get_rates(self, email: str) -> Dict[str, float]:
+        series = self.series.get(email)
+
+        if series is None:
+            return {}
+
+        current_upload_rate, current_download_rate = series.get_current_rates()
+
+        return {
+            'upload_rate': round(series.upload_rate, 3),
+            'download_rate': round(series.download_rate, 3),
+            'current_upload_rate': round(current_upload_rate, 3),
+            'current_download_rate': round(current_download_rate, 3)
+        }
+
+    def retain(self, emails: Iterable[str]) -> None:
+        # forget deleted users
+        emails = set(emails)
+
+        for email in [email for email in self.series if email not in emails]:
+            del self.series[email]
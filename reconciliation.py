@@ -0,0 +1,156 @@
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+import time
+
+from loki_logger import LOGGER
+from provisioning import gather_bounded
+from schemas import XrayError
+from xray_cluster import XrayCluster
+
+import models
+
+
+class Reconciler:
+    """
+    Compares users present in every Xray node with the users table and
+    applies the missing adds and removes.
+    """
+
+    def __init__(
+        self,
+        xray: XrayCluster,
+        load_users: Callable[[], Awaitable[List[models.User]]],
+        concurrency: int = 32,
+        verified_ttl: float = 3600
+    ) -> None:
+        self.xray = xray
+        self.load_users = load_users
+        self.concurrency = concurrency
+
+        # counters appear with the first traffic and stay after removal, so they
+        # prove nothing and every user is checked by an add or remove, answers
+        # like "already exists" are remembered for a while
+        self.verified_ttl = verified_ttl
+        self.verified: Dict[str, Dict[str, Tuple[float, str]]] = {name: {} for name in xray.nodes}
+
+        # counters without a user, only new ones are counted as drift
+        self.unknown: Dict[str, Set[str]] = {name: set() for name in xray.nodes}
+
+        self.last_result: Dict[str, int] = {}
+        self.totals: Dict[str, int] = {}
+
+    def is_verified(self, name: str, email: str, action: str, now: float) -> bool:
+        # an answer holds only for the same action, a user deactivated since then is checked again
+        until, verified_action = self.verified[name].get(email, (0, None))
+        return until > now and verified_action == action
+
+    async def reconcile(self) -> Dict[str, int]:
+        start_time = time.monotonic()
+        result = dict.fromkeys(('missing', 'extra', 'unknown', 'added', 'removed', 'failed'), 0)
+
+        usersList = await self.load_users()
+        emails = {user.email for user in usersList}
+        operations: List[Tuple[bool, str, str, models.User]] = []
+
+        for name, present in (await self.xray.get_user_emails()).items():
+            # deleted users and expired answers are forgotten
+            self.verified[name] = {
+                email: verified for email, verified in self.verified[name].items()
+                if email in emails and verified[0] > start_time
+            }
+
+            if type(present) is XrayError:
+                LOGGER.error(
+                    'RECONCILIATION ERROR',
+                    extra={
+                        'tags': {
+                            'node': name,
+                            'error_msg': present.message
+                        }
+                    }
+                )
+                continue
+
+            unknown = present - emails
+            result['unknown'] += len(unknown - self.unknown[name])
+            self.unknown[name] = unknown
+
+            for user in usersList:
+                action = 'add' if user.is_active else 'remove'
+
+                if (
+                    not self.xray.is_serving(name, user.inbound_tag, user.node) or
+                    self.is_verified(name, user.email, action, start_time)
+                ):
+                    continue
+
+                # counters only hint at drift, such users are checked first
+                is_suspected = (user.email in present) != user.is_active
+                operations.append((is_suspected, action, name, user))
+
+        operations.sort(key=lambda operation: not operation[0])
+
+        async def apply(operation: Tuple[bool, str, str, models.User]):
+            _, action, name, user = operation
+            node = self.xray.nodes[name]
+
+            if action == 'add':
+                response = await node.add_user(
+                    inbound_tag=user.inbound_tag,
+                    email=user.email,
+                    level=user.level,
+                    type=user.type,
+                    password=user.password,
+                    cipher_type=user.cipher_type,
+                    uuid=user.uuid,
+                    flow=user.flow,
+                )
+                is_noop = type(response) is XrayError and response.message.endswith('already exists.')
+
+            else:
+                response = await node.remove_user(user.inbound_tag, user.email)
+                is_noop = type(response) is XrayError and response.message.endswith('not found.')
+
+            if not is_noop:
+                result['missing' if action == 'add' else 'extra'] += 1
+
+            if type(response) is XrayError and not is_noop:
+                result['failed'] += 1
+
+                LOGGER.error(
+                    'RECONCILIATION ERROR',
+                    extra={
+                        'tags': {
+                            'node': name,
+                            'action': action,
+                            'error_msg': response.message,
+                            'email': user.email
+                        }
+                    }
+                )
+                return
+
+            if not is_noop:
+                result['added' if action == 'add' else 'removed'] += 1
+
+            self.verified[name][user.email] = (time.monotonic() + self.verified_ttl, action)
+
+        await gather_bounded(operations, apply, self.concurrency)
+
+        self.last_result = result
+
+        for key, value in result.items():
+            self.totals[key] = self.totals.get(key, 0) + value
+
+        LOGGER.info(
+            'RECONCILIATION RESULT',
+            extra={
+                'tags': {
+                    **result,
+                    'users': len(usersList),
+                    'duration_ms': round((time.monotonic() - start_time) * 1000)
+                }
+            }
+        )
+
+        return result
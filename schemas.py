@@ -1,15 +1,25 @@
 from enum import Enum
-from typing import Generic, List
+from typing import Dict, Generic, List
 from annotated_types import T
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from datetime import datetime
 
 
+def to_local(date: datetime | None) -> datetime | None:
+    # dates are stored in local time without timezone, as all dates of the daemon
+    return date.astimezone().replace(tzinfo=None) if date and date.tzinfo else date
+
+
 class XrayError:
     def __init__(self, message: str) -> None:
         self.message = message
 
 
+class OperationEnum(Enum):
+    add = "add"
+    remove = "remove"
+
+
 class NodeTypeEnum(Enum):
     Shadowsocks = "shadowsocks"
     Shadowsocks_2022 = "shadowsocks_2022"
@@ -19,6 +29,22 @@ class NodeTypeEnum(Enum):
     Socks = "socks"
 
 
+class TopMetricEnum(Enum):
+    traffic = "traffic"
+    rate = "rate"
+    online_sessions = "online_sessions"
+
+
+class ProfileTargetEnum(Enum):
+    process = "process"
+    api = "api"
+
+
+class ProfileModeEnum(Enum):
+    cprofile = "cprofile"
+    sampling = "sampling"
+
+
 class CipherType(Enum):
     unknown = 0
     aes_128_gcm = 5
@@ -40,7 +66,15 @@ class CreateUser(BaseModel):
     type: NodeTypeEnum = Field()
     cipher_type: CipherType | None = Field(default=CipherType.unknown)
     flow: str | None = Field(default=None, max_length=32)
+    node: str | None = Field(default=None, max_length=64)
     limit: int | None = Field(default=0)
+    max_ips: int | None = Field(default=None, ge=0)
+    expires_at: datetime | None = Field(default=None)
+
+    @field_validator('expires_at')
+    @classmethod
+    def validate_expires_at(cls, value: datetime | None) -> datetime | None:
+        return to_local(value)
 
 
 class ReadUser(BaseModel):
@@ -53,13 +87,31 @@ class ReadUser(BaseModel):
     cipher_type: CipherType | None
     uuid: str | None
     flow: str | None
+    node: str | None
     traffic: int
     online_sessions: int
     limit: int
+    max_ips: int | None
+    suspended_until: datetime | None
+    expires_at: datetime | None
     is_active: bool
     is_blocked: bool
     created_date: datetime
     reset_traffic_date: datetime
+    version: int | None
+    upload_rate: float | None = None
+    download_rate: float | None = None
+    current_upload_rate: float | None = None
+    current_download_rate: float | None = None
+
+
+class TopUser(BaseModel):
+    inbound_tag: str
+    email: str
+    traffic: int
+    online_sessions: int
+    upload_rate: float
+    download_rate: float
 
 
 class ReadUsers(BaseModel, Generic[T]):
@@ -67,13 +119,60 @@ class ReadUsers(BaseModel, Generic[T]):
     total: int
 
 
+class UserKey(BaseModel):
+    inbound_tag: str
+    email: str
+
+
+class UserKeys(BaseModel):
+    users: List[UserKey] = Field(min_length=1, max_length=1000)
+
+
+class ReadUsersBatch(BaseModel):
+    # inbound_tag -> email -> user
+    users: Dict[str, Dict[str, ReadUser]]
+    missing: List[UserKey]
+
+
+class DeletedUser(BaseModel):
+    inbound_tag: str
+    email: str
+    version: int
+    deleted_date: datetime
+
+
+class ReadChanges(BaseModel, Generic[T]):
+    users: List[T]
+    deleted: List[DeletedUser]
+    # "since" of the next request
+    cursor: int
+    has_more: bool
+
+
 class UpdateUser(BaseModel):
     traffic: int | None = Field(default=None)
     limit: int | None = Field(default=None)
+    max_ips: int | None = Field(default=None, ge=0)
     online_sessions: int | None = Field(default=None)
     is_active: bool | None = Field(default=None)
     is_blocked: bool | None = Field(default=None)
     reset_traffic_date: datetime | None = Field(default=None)
+    suspended_until: datetime | None = Field(default=None)
+    expires_at: datetime | None = Field(default=None)
+
+    @field_validator('expires_at')
+    @classmethod
+    def validate_expires_at(cls, value: datetime | None) -> datetime | None:
+        return to_local(value)
+
+
+class TrafficUsage(BaseModel):
+    inbound_tag: str
+    email: str | None
+    start: datetime
+    end: datetime
+    upload_traffic: int
+    download_traffic: int
 
 
 class Inbound(BaseModel):
@@ -86,6 +185,88 @@ class ReadStats(BaseModel, Generic[T]):
     inbounds: List[T]
 
 
+class CircuitState(BaseModel):
+    state: str
+    failures: int
+    open_for_seconds: float
+
+
+class Provisioning(BaseModel):
+    is_ready: bool
+    total: int
+    done: int
+    added: int
+    skipped: int
+    failed: int
+    started_date: datetime | None
+    finished_date: datetime | None
+
+
+class Health(BaseModel):
+    xray: Dict[str, CircuitState]
+    provisioning: Provisioning
+
+
+class Probe(BaseModel):
+    is_ok: bool
+    latency_ms: float | None
+    error: str | None
+
+
+class XrayProbe(Probe):
+    circuit: CircuitState
+
+
+class Liveness(BaseModel):
+    is_alive: bool
+    probe_age_seconds: float | None
+    last_cycle_age_seconds: float
+
+
+class Readiness(BaseModel):
+    is_ready: bool
+    checked_date: datetime | None
+    database: Probe
+    xray: Dict[str, XrayProbe]
+    last_cycle_date: datetime | None
+    last_cycle_age_seconds: float
+    provisioning: Provisioning
+
+
+class LoopStall(BaseModel):
+    date: datetime
+    lag_ms: float | None
+    stack: str
+
+
+class LoopLag(BaseModel):
+    interval_ms: float
+    threshold_ms: float
+    samples: int
+    p50: float
+    p90: float
+    p99: float
+    max: float
+    stalls: List[LoopStall]
+
+
+class CreateProfile(BaseModel):
+    target: ProfileTargetEnum = Field(default=ProfileTargetEnum.process)
+    mode: ProfileModeEnum = Field(default=ProfileModeEnum.cprofile)
+    runs: int = Field(default=1, ge=1, le=100)
+    seconds: float = Field(default=30, gt=0, le=3600)
+
+
+class ReadProfile(BaseModel):
+    is_armed: bool
+    target: ProfileTargetEnum | None
+    mode: ProfileModeEnum | None
+    runs_left: int
+    started_date: datetime | None
+    finished_date: datetime | None
+    has_result: bool
+
+
 class Error(BaseModel):
     message: str
     code: int
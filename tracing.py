@@ -0,0 +1,309 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, List
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import asyncio, functools, httpx, json, os, random, time
+
+from loki_logger import LOGGER
+
+
+load_dotenv('.env')
+
+SERVICE_NAME = 'xray-daemon'
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+def to_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start_time', 'end_time', 'attributes', 'error', 'is_sampled')
+
+    def __init__(self, name: str, parent: 'Span | None', kind: int, is_sampled: bool, attributes: Dict[str, Any]) -> None:
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.kind = kind
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.attributes = attributes
+        self.error: str | None = None
+        self.is_sampled = is_sampled
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': [to_attribute(key, value) for key, value in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1}
+        }
+
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+
+        return span
+
+
+class Exporter(ABC):
+    @abstractmethod
+    async def export(self, spans: List[Dict[str, Any]]) -> None:
+        pass
+
+
+class FileExporter(Exporter):
+    """
+    Appends spans as JSON lines in the OTLP span notation.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def write(self, spans: List[Dict[str, Any]]) -> None:
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.writelines(json.dumps(span, separators=(',', ':')) + '\n' for span in spans)
+
+    async def export(self, spans: List[Dict[str, Any]]) -> None:
+        await asyncio.to_thread(self.write, spans)
+
+
+class OtlpExporter(Exporter):
+    """
+    Sends spans to an OTLP/HTTP collector with the JSON encoding.
+    """
+
+    def __init__(self, endpoint: str, headers: Dict[str, str] = None, timeout: float = 5.0) -> None:
+        self.url = f"{endpoint.rstrip('/')}/v1/traces"
+        self.headers = headers or {}
+        self.timeout = timeout
+
+    async def export(self, spans: List[Dict[str, Any]]) -> None:
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [to_attribute('service.name', SERVICE_NAME)]},
+                'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': spans}]
+            }]
+        }
+
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            response = await client.post(self.url, json=payload, headers=self.headers)
+            response.raise_for_status()
+
+
+class Tracer:
+    """
+    Spans are parented by a context variable, so concurrent requests and
+    tasks started by asyncio.gather get their own trace. Finished spans
+    are queued and exported in batches by flush.
+    """
+
+    def __init__(self, exporter: Exporter | None, sample_ratio: float = 1.0, max_queue: int = 10000) -> None:
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.max_queue = max_queue
+
+        self.current: ContextVar[Span | None] = ContextVar('current_span', default=None)
+        self.queue: List[Span] = []
+        self.dropped = 0
+
+    def start_span(self, name: str, kind: int = INTERNAL, is_root: bool = False, **attributes) -> Span | None:
+        if self.exporter is None:
+            return None
+
+        parent = self.current.get()
+
+        # statements and RPCs are traced only inside a request or a cycle
+        if parent is None and not is_root:
+            return None
+
+        if parent is not None and not parent.is_sampled:
+            return None
+
+        return Span(
+            name,
+            parent,
+            kind,
+            parent.is_sampled if parent else random.random() < self.sample_ratio,
+            attributes
+        )
+
+    def end_span(self, span: Span | None, error: str | None = None) -> None:
+        if span is None:
+            return
+
+        span.end_time = time.time_ns()
+        span.error = error
+
+        if not span.is_sampled:
+            return
+
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+
+        self.queue.append(span)
+
+    @contextmanager
+    def span(self, name: str, kind: int = INTERNAL, is_root: bool = False, **attributes) -> Iterator[Span | None]:
+        span = self.start_span(name, kind, is_root, **attributes)
+
+        if span is None:
+            yield None
+            return
+
+        token = self.current.set(span)
+        error = None
+
+        try:
+            yield span
+
+        except BaseException as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+
+        finally:
+            self.current.reset(token)
+            self.end_span(span, error)
+
+    def record(self, name: str, duration: float, **attributes) -> None:
+        # child span of the current one which ended now, for code measured with a timer
+        span = self.start_span(name, **attributes)
+
+        if span is None:
+            return
+
+        span.start_time = time.time_ns() - int(duration * 1e9)
+        self.end_span(span)
+
+    def traced(self, name: str) -> Callable:
+        def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name, is_root=True):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    async def flush(self) -> None:
+        if not self.queue:
+            return
+
+        spans, self.queue = self.queue, []
+
+        try:
+            await self.exporter.export([span.to_otlp() for span in spans])
+
+        except Exception as e:
+            LOGGER.error(
+                'TRACING ERROR',
+                extra={
+                    'tags': {
+                        'error_type': type(e).__name__,
+                        'error_msg': str(e),
+                        'spans': len(spans),
+                        'dropped': self.dropped
+                    }
+                }
+            )
+
+
+def create_exporter() -> Exporter | None:
+    exporter = os.getenv('TRACING_EXPORTER', 'none').lower()
+
+    if exporter == 'file':
+        return FileExporter(os.getenv('TRACING_FILE_PATH', 'traces.jsonl'))
+
+    if exporter == 'otlp':
+        # "authorization=Bearer x,x-scope=y"
+        headers = dict(
+            item.split('=', 1) for item in os.getenv('TRACING_OTLP_HEADERS', '').split(',') if '=' in item
+        )
+
+        return OtlpExporter(os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318'), headers)
+
+    return None
+
+TRACER = Tracer(
+    create_exporter(),
+    sample_ratio=float(os.getenv('TRACING_SAMPLE_RATIO', 1.0)),
+    max_queue=int(os.getenv('TRACING_MAX_QUEUE', 10000))
+)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        span = TRACER.start_span(
+            f'SQL {statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""}',
+            CLIENT,
+            **{'db.statement': statement[:1000]}
+        )
+        conn.info.setdefault('query_spans', []).append(span)
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        TRACER.end_span(conn.info['query_spans'].pop())
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        spans = context.connection.info.get('query_spans') if context.connection else None
+
+        if spans:
+            TRACER.end_span(spans.pop(), f'{type(context.original_exception).__name__}: {context.original_exception}')
+
+
+class TracingMiddleware:
+    """
+    Opens a server span per request, named by the route template. With a
+    name, a child span is opened instead, so the time spent in middlewares
+    between both is visible.
+    """
+
+    def __init__(self, app, name: str = None) -> None:
+        self.app = app
+        self.name = name
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or TRACER.exporter is None:
+            return await self.app(scope, receive, send)
+
+        with TRACER.span(self.name or scope['method'], SERVER if self.name is None else INTERNAL, is_root=self.name is None) as span:
+            async def send_wrapper(message):
+                if span is not None and message['type'] == 'http.response.start':
+                    span.attributes['http.status_code'] = message['status']
+
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+
+            finally:
+                route = scope.get('route')
+
+                if span is not None and self.name is None:
+                    span.name = f"{scope['method']} {route.path if route is not None else 'unmatched'}"
+                    span.attributes['http.method'] = scope['method']
+                    span.attributes['http.target'] = scope['path']
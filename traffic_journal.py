@@ -0,0 +1,74 @@
+from typing import Dict, List
+
+import asyncio, json, os
+
+
+class TrafficJournal:
+    """
+    Append-only file with traffic drained from Xray. A batch is fsynced
+    before the database is touched and the id of the last applied batch is
+    committed with the traffic, so batches lost by a crash are replayed
+    exactly once on startup.
+    """
+
+    STATE_KEY = 'traffic_journal_batch'
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.last_batch_id = 0
+        self.is_initialized = False
+
+        # batches written in this run but not committed to the database yet
+        self.pending: Dict[int, Dict[str, List[int]]] = {}
+
+    def read(self) -> Dict[int, Dict[str, List[int]]]:
+        batches = {}
+
+        if not os.path.exists(self.path):
+            return batches
+
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+
+                # the last line may be torn by a crash in the middle of a write
+                except ValueError:
+                    break
+
+                batches[record['batch']] = record['traffic']
+                self.last_batch_id = max(self.last_batch_id, record['batch'])
+
+        return batches
+
+    def write(self, batch_id: int, traffic: Dict[str, List[int]]) -> None:
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps({'batch': batch_id, 'traffic': traffic}, separators=(',', ':')) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    async def append(self, traffic: Dict[str, List[int]]) -> Dict[str, List[int]]:
+        """
+        Write a batch and return the traffic of all batches which are not committed yet
+        """
+        self.last_batch_id += 1
+        await asyncio.to_thread(self.write, self.last_batch_id, traffic)
+        self.pending[self.last_batch_id] = traffic
+
+        total: Dict[str, List[int]] = {}
+
+        for batch in self.pending.values():
+            for email, (uplink, downlink) in batch.items():
+                total.setdefault(email, [0, 0])
+                total[email][0] += uplink
+                total[email][1] += downlink
+
+        return total
+
+    def commit(self) -> None:
+        # batches up to the committed id are skipped on replay, so truncation needs no fsync
+        self.pending.clear()
+        self.is_initialized = True
+
+        with open(self.path, 'w', encoding='utf-8'):
+            pass
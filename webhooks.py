@@ -0,0 +1,171 @@
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import asyncio, hashlib, hmac, httpx, json, random, time, uuid
+
+from loki_logger import LOGGER
+
+
+def sign(secret: str, timestamp: int, body: bytes) -> str:
+    # the timestamp is signed too, so a captured request cannot be replayed later
+    return 'sha256=' + hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+
+
+class WebhookDispatcher:
+    """
+    Delivers user state changes to webhook URLs in signed batches. Events
+    are kept per user until they are sent, a newer event of the same user
+    replaces the pending one, so the queue is bounded by the number of
+    users and emitting never waits for the network.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        secret: str | None = None,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_pending: int = 10000,
+        max_attempts: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 5.0
+    ) -> None:
+        self.urls = urls
+        self.secret = secret
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        # (inbound_tag, email) -> latest event, in the order users first changed
+        self.pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.client: httpx.AsyncClient | None = None
+
+    def emit(self, event_type: str, inbound_tag: str, email: str, **data) -> None:
+        if not self.urls:
+            return
+
+        key = (inbound_tag, email)
+
+        if key in self.pending:
+            self.coalesced += 1
+
+        elif len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        self.pending[key] = {
+            'id': uuid.uuid4().hex,
+            'type': event_type,
+            'inbound_tag': inbound_tag,
+            'email': email,
+            'date': datetime.now().replace(microsecond=0).isoformat(),
+            **data
+        }
+
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def start(self) -> None:
+        if not self.urls:
+            return
+
+        if self.task is None or self.task.done():
+            self.client = httpx.AsyncClient(timeout=self.timeout)
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+
+        self.task.cancel()
+
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+        # what is left is sent once without retries
+        while self.pending:
+            batch = self.pop_batch()
+            await asyncio.gather(*(self.deliver(url, batch, retries=False) for url in self.urls))
+
+        await self.client.aclose()
+
+    def pop_batch(self) -> List[Dict[str, Any]]:
+        keys = list(self.pending)[:self.batch_size]
+        return [self.pending.pop(key) for key in keys]
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wakeup.clear()
+
+            while self.pending:
+                batch = self.pop_batch()
+
+                # a slow URL delays the next batch, events meanwhile coalesce in pending
+                await asyncio.gather(*(self.deliver(url, batch) for url in self.urls))
+
+    async def deliver(self, url: str, events: List[Dict[str, Any]], retries: bool = True) -> bool:
+        body = json.dumps({'events': events}, separators=(',', ':')).encode()
+        attempts = self.max_attempts if retries else 1
+
+        # retries of a batch keep its id, so the receiver can ignore a repeated delivery
+        batch_id = uuid.uuid4().hex
+
+        for attempt in range(attempts):
+            timestamp = int(time.time())
+            headers = {
+                'Content-Type': 'application/json',
+                'X-Webhook-Id': batch_id,
+                'X-Webhook-Timestamp': str(timestamp)
+            }
+
+            if self.secret:
+                headers['X-Webhook-Signature'] = sign(self.secret, timestamp, body)
+
+            try:
+                response = await self.client.post(url, content=body, headers=headers)
+                response.raise_for_status()
+
+                self.delivered += len(events)
+                return True
+
+            except Exception as e:
+                error = e
+
+            if attempt + 1 < attempts:
+                backoff = min(self.base_backoff * 2 ** attempt, self.max_backoff)
+                await asyncio.sleep(backoff * random.uniform(0.5, 1))
+
+        self.failed += len(events)
+
+        LOGGER.error(
+            'WEBHOOK ERROR',
+            extra={
+                'tags': {
+                    'url': url,
+                    'events': len(events),
+                    'error_type': type(error).__name__,
+                    'error_msg': str(error)
+                }
+            }
+        )
+
+        return False
@@ -1,6 +1,6 @@
-import grpc
+import asyncio, grpc, random, time
 
-from typing import Union
+from typing import Any, Dict, List, Set, Tuple, Union
 from google.protobuf import message as _message
 from xray_rpc.app.proxyman.command import (
 	command_pb2_grpc as proxyman_command_pb2_grpc,
@@ -19,15 +19,254 @@ from xray_rpc.proxy.vless import account_pb2 as vless_account_pb2
 from xray_rpc.proxy.vmess import account_pb2 as vmess_account_pb2
 from xray_rpc.proxy.socks import config_pb2 as socks_config_pb2
 
+from metrics import XRAY_RPC_DURATION
+from tracing import CLIENT, TRACER
 from schemas import NodeTypeEnum, XrayError
 
 
 def to_typed_message(message: _message):
 	return typed_message_pb2.TypedMessage(type=message.DESCRIPTOR.full_name, value=message.SerializeToString())
 
+def channel_options(
+	keepalive_time_ms: int = 300000,
+	keepalive_timeout_ms: int = 20000,
+	max_message_length: int = 64 * 1024 * 1024,
+	initial_reconnect_backoff_ms: int = 1000,
+	max_reconnect_backoff_ms: int = 10000,
+	local_subchannel_pool: bool = False,
+) -> List[Tuple[str, Any]]:
+	"""
+	Build gRPC channel options
+	:param keepalive_time_ms: ping interval, Xray rejects pings more often than every 5 minutes
+	:param keepalive_timeout_ms: time to wait for ping acknowledgement
+	:param max_message_length: max send/receive message size (QueryStats replies grow with users)
+	:param initial_reconnect_backoff_ms: first reconnect delay
+	:param max_reconnect_backoff_ms: upper bound of reconnect delay
+	:param local_subchannel_pool: do not share connections between channels
+	:return:
+	"""
+	options = [
+		("grpc.keepalive_time_ms", keepalive_time_ms),
+		("grpc.keepalive_timeout_ms", keepalive_timeout_ms),
+		("grpc.keepalive_permit_without_calls", 0),
+		("grpc.http2.max_pings_without_data", 0),
+		("grpc.max_send_message_length", max_message_length),
+		("grpc.max_receive_message_length", max_message_length),
+		("grpc.initial_reconnect_backoff_ms", initial_reconnect_backoff_ms),
+		("grpc.min_reconnect_backoff_ms", initial_reconnect_backoff_ms),
+		("grpc.max_reconnect_backoff_ms", max_reconnect_backoff_ms),
+	]
+
+	if local_subchannel_pool:
+		options.append(("grpc.use_local_subchannel_pool", 1))
+
+	return options
+
+def parse_user_stat_name(name: str) -> Union[Tuple[str, str], None]:
+	"""
+	Parse a user traffic counter name
+	:param name: e.g. "user>>>email>>>traffic>>>uplink"
+	:return: email and direction, None for any other counter
+	"""
+	parts = name.split(">>>")
+
+	if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic" or parts[3] not in ("uplink", "downlink"):
+		return None
+
+	return parts[1], parts[3]
+
+# codes meaning the core did not answer, other codes are Xray business errors
+TRANSIENT_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+HANDLER_METHODS = ("AlterInbound",)
+
+class CircuitOpenError(grpc.RpcError):
+	def code(self) -> grpc.StatusCode:
+		return grpc.StatusCode.UNAVAILABLE
+
+	def details(self) -> str:
+		return "Xray circuit breaker is open."
+
+class CircuitBreaker(object):
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half_open"
+
+	def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 15.0):
+		self.failure_threshold = max(failure_threshold, 1)
+		self.recovery_timeout = recovery_timeout
+
+		self.state = self.CLOSED
+		self.failures = 0
+		self.opened_at = 0.0
+		self.trial_in_flight = False
+
+	def allow(self) -> bool:
+		"""
+		Check if call may go to Xray, in half-open state only one trial call passes
+		:return:
+		"""
+		if self.state == self.OPEN:
+			if time.monotonic() - self.opened_at < self.recovery_timeout:
+				return False
+
+			self.state = self.HALF_OPEN
+			self.trial_in_flight = False
+
+		if self.state == self.HALF_OPEN:
+			if self.trial_in_flight:
+				return False
+
+			self.trial_in_flight = True
+
+		return True
+
+	def record_success(self):
+		self.state = self.CLOSED
+		self.failures = 0
+		self.trial_in_flight = False
+
+	def record_failure(self):
+		self.failures += 1
+		self.trial_in_flight = False
+
+		if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+			self.state = self.OPEN
+			self.opened_at = time.monotonic()
+
+	def record_abort(self):
+		# a trial which was cancelled or failed in another way re-opens the breaker, otherwise no call would pass again
+		if self.state == self.HALF_OPEN and self.trial_in_flight:
+			self.record_failure()
+
+	def snapshot(self) -> Dict[str, Any]:
+		return {
+			"state": self.state,
+			"failures": self.failures,
+			"open_for_seconds": round(time.monotonic() - self.opened_at, 3) if self.state != self.CLOSED else 0,
+		}
+
 class Xray(object):
-	def __init__(self, api_host: str, api_port: int):
-		self.xray_client = grpc.insecure_channel(target=f"{api_host}:{api_port}")
+	def __init__(
+		self,
+		api_host: str,
+		api_port: int,
+		options: List[Tuple[str, Any]] = None,
+		compression: grpc.Compression = grpc.Compression.NoCompression,
+		pool_size: int = 1,
+		read_timeout: float = 2.0,
+		write_timeout: float = 5.0,
+		read_retries: int = 2,
+		retry_backoff: float = 0.1,
+		bulk_timeout: float = 30.0,
+		breaker: CircuitBreaker = None,
+		name: str = None,
+	):
+		self.target = f"{api_host}:{api_port}"
+		self.name = name or self.target
+		self.options = options if options is not None else channel_options(local_subchannel_pool=pool_size > 1)
+		self.compression = compression
+		self.pool_size = max(pool_size, 1)
+
+		self.read_timeout = read_timeout
+		self.write_timeout = write_timeout
+		self.read_retries = max(read_retries, 0)
+		self.retry_backoff = retry_backoff
+		self.bulk_timeout = bulk_timeout
+		self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+		# channels are bound to the event loop, so they are opened on first call
+		self.channels = []
+		self.stubs = []
+		self.next_stub = 0
+
+	def get_stubs(self) -> Tuple[stats_command_pb2_grpc.StatsServiceStub, proxyman_command_pb2_grpc.HandlerServiceStub]:
+		"""
+		Get stubs of the next channel in the pool (round-robin)
+		:return:
+		"""
+		if not self.stubs:
+			for _ in range(self.pool_size):
+				channel = grpc.aio.insecure_channel(
+					target=self.target,
+					options=self.options,
+					compression=self.compression,
+				)
+
+				self.channels.append(channel)
+				self.stubs.append((
+					stats_command_pb2_grpc.StatsServiceStub(channel),
+					proxyman_command_pb2_grpc.HandlerServiceStub(channel),
+				))
+
+		self.next_stub = (self.next_stub + 1) % len(self.stubs)
+		return self.stubs[self.next_stub]
+
+	async def close(self):
+		"""
+		Close all channels of the pool
+		:return:
+		"""
+		channels, self.channels, self.stubs = self.channels, [], []
+
+		for channel in channels:
+			await channel.close()
+
+	async def call(
+		self,
+		method: str,
+		request: _message.Message,
+		idempotent: bool = False,
+		timeout: float = None,
+	) -> _message.Message:
+		"""
+		Call Xray RPC with deadline and circuit breaker, idempotent calls are retried with jittered backoff
+		:param method: RPC name of StatsService or HandlerService
+		:param request: request message
+		:param idempotent: call is safe to repeat
+		:param timeout: deadline in seconds instead of the read/write one
+		:return:
+		"""
+		if timeout is None:
+			timeout = self.read_timeout if idempotent else self.write_timeout
+
+		attempts = self.read_retries + 1 if idempotent else 1
+
+		for attempt in range(attempts):
+			if not self.breaker.allow():
+				raise CircuitOpenError()
+
+			stats_stub, handler_stub = self.get_stubs()
+			stub = handler_stub if method in HANDLER_METHODS else stats_stub
+
+			start_time = time.perf_counter()
+			span = TRACER.start_span(f"xray {method}", CLIENT, **{"rpc.method": method, "xray.node": self.name, "attempt": attempt})
+
+			try:
+				response = await getattr(stub, method)(request, timeout=timeout)
+			except grpc.RpcError as rpc_err:
+				XRAY_RPC_DURATION.labels(self.name, method, rpc_err.code().name).observe(time.perf_counter() - start_time)
+				TRACER.end_span(span, f"{rpc_err.code().name}: {rpc_err.details()}")
+
+				if rpc_err.code() not in TRANSIENT_CODES:
+					self.breaker.record_success()
+					raise
+
+				self.breaker.record_failure()
+
+				if attempt + 1 >= attempts:
+					raise
+
+				await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+			except BaseException as err:
+				TRACER.end_span(span, f"{type(err).__name__}: {err}")
+				self.breaker.record_abort()
+				raise
+			else:
+				XRAY_RPC_DURATION.labels(self.name, method, 'OK').observe(time.perf_counter() - start_time)
+				TRACER.end_span(span)
+
+				self.breaker.record_success()
+				return response
 
 	async def get_user_online_sessions(self, email: str) -> Union[int, XrayError]:
 		"""
@@ -35,10 +274,11 @@ class Xray(object):
 		:param email: user e-mail
 		:return:
 		"""
-		stub = stats_command_pb2_grpc.StatsServiceStub(self.xray_client)
 		try:
-			resp = stub.GetStatsOnline(
-				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>online", reset=False)
+			resp = await self.call(
+				"GetStatsOnline",
+				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>online", reset=False),
+				idempotent=True,
 			)
 			return resp.stat.value
 		except grpc.RpcError as rpc_err:
@@ -48,6 +288,22 @@ class Xray(object):
 
 			return XrayError(detail)
 
+	async def get_user_online_ips(self, email: str) -> Union[Dict[str, int], XrayError]:
+		"""
+		Get online IPs of user
+		:param email: user e-mail
+		:return: IP -> last seen unix time
+		"""
+		try:
+			resp = await self.call(
+				"GetStatsOnlineIpList",
+				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>online", reset=False),
+				idempotent=True,
+			)
+			return dict(resp.ips)
+		except grpc.RpcError as rpc_err:
+			return XrayError(rpc_err.details())
+
 	async def get_user_upload_traffic(self, email: str, reset: bool = False) -> Union[int, XrayError]:
 		"""
 		Get user upload traffic
@@ -55,10 +311,11 @@ class Xray(object):
 		:param reset: reset upload traffic
 		:return:
 		"""
-		stub = stats_command_pb2_grpc.StatsServiceStub(self.xray_client)
 		try:
-			resp = stub.GetStats(
-				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>traffic>>>uplink", reset=reset)
+			resp = await self.call(
+				"GetStats",
+				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>traffic>>>uplink", reset=reset),
+				idempotent=not reset,
 			)
 			return resp.stat.value
 		except grpc.RpcError as rpc_err:
@@ -75,10 +332,11 @@ class Xray(object):
 		:param reset: reset download traffic
 		:return:
 		"""
-		stub = stats_command_pb2_grpc.StatsServiceStub(self.xray_client)
 		try:
-			resp = stub.GetStats(
-				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>traffic>>>downlink", reset=reset)
+			resp = await self.call(
+				"GetStats",
+				stats_command_pb2.GetStatsRequest(name=f"user>>>{email}>>>traffic>>>downlink", reset=reset),
+				idempotent=not reset,
 			)
 			return resp.stat.value
 		except grpc.RpcError as rpc_err:
@@ -94,10 +352,11 @@ class Xray(object):
 		:param inbound_tag: inbound tag
 		:return:
 		"""
-		stub = stats_command_pb2_grpc.StatsServiceStub(self.xray_client)
 		try:
-			resp = stub.GetStats(
-				stats_command_pb2.GetStatsRequest(name=f"inbound>>>{inbound_tag}>>>traffic>>>uplink", reset=reset)
+			resp = await self.call(
+				"GetStats",
+				stats_command_pb2.GetStatsRequest(name=f"inbound>>>{inbound_tag}>>>traffic>>>uplink", reset=reset),
+				idempotent=not reset,
 			)
 			return resp.stat.value
 		except grpc.RpcError as rpc_err:
@@ -109,15 +368,122 @@ class Xray(object):
 		:param inbound_tag: inbound tag
 		:return:
 		"""
-		stub = stats_command_pb2_grpc.StatsServiceStub(self.xray_client)
 		try:
-			resp = stub.GetStats(
-				stats_command_pb2.GetStatsRequest(name=f"inbound>>>{inbound_tag}>>>traffic>>>downlink", reset=reset)
+			resp = await self.call(
+				"GetStats",
+				stats_command_pb2.GetStatsRequest(name=f"inbound>>>{inbound_tag}>>>traffic>>>downlink", reset=reset),
+				idempotent=not reset,
+			)
+			return resp.stat.value
+		except grpc.RpcError as rpc_err:
+			return XrayError(rpc_err.details())
+
+	async def query_stats(self, pattern: str, reset: bool = False) -> Union[Dict[str, int], XrayError]:
+		"""
+		Get all counters matching pattern in one call
+		:param pattern: substring of counter name, e.g. "user>>>"
+		:param reset: reset matched counters
+		:return: counter name to value
+		"""
+		try:
+			resp = await self.call(
+				"QueryStats",
+				stats_command_pb2.QueryStatsRequest(pattern=pattern, reset=reset),
+				idempotent=not reset,
+				timeout=self.bulk_timeout,
+			)
+			return {stat.name: stat.value for stat in resp.stat}
+		except grpc.RpcError as rpc_err:
+			return XrayError(rpc_err.details())
+
+	async def get_stat(self, name: str, reset: bool = False) -> Union[int, XrayError]:
+		"""
+		Get one counter by its full name
+		:param name: e.g. "user>>>email>>>traffic>>>uplink"
+		:param reset: reset the counter
+		:return:
+		"""
+		try:
+			resp = await self.call(
+				"GetStats",
+				stats_command_pb2.GetStatsRequest(name=name, reset=reset),
+				idempotent=not reset,
 			)
 			return resp.stat.value
 		except grpc.RpcError as rpc_err:
 			return XrayError(rpc_err.details())
 
+	async def get_users_traffic(self, reset: bool = False, concurrency: int = 64) -> Union[Dict[str, int], XrayError]:
+		"""
+		Get traffic counters of all users, counters of other kinds are never reset
+		:param reset: reset the returned counters
+		:param concurrency: GetStats calls in flight when counters are reset one by one
+		:return: counter name to value
+		"""
+		# the pattern is a substring, a reset with it would also reset tags like "inbound>>>vless-user>>>..."
+		stats = await self.query_stats("user>>>")
+
+		if type(stats) is XrayError:
+			return stats
+
+		names = [name for name in stats if parse_user_stat_name(name) is not None]
+
+		if not reset:
+			return {name: stats[name] for name in names}
+
+		if len(names) == len(stats):
+			stats = await self.query_stats("user>>>", reset=True)
+
+			if type(stats) is XrayError:
+				return stats
+
+			return {name: value for name, value in stats.items() if parse_user_stat_name(name) is not None}
+
+		semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+		async def drain(name: str) -> Union[int, XrayError]:
+			async with semaphore:
+				return await self.get_stat(name, reset=True)
+
+		values = await asyncio.gather(*(drain(name) for name in names))
+		traffic = {name: value for name, value in zip(names, values) if type(value) is not XrayError}
+
+		# counters which were not reset come with the next call, the drained ones must not be lost
+		errors = [value for value in values if type(value) is XrayError and not value.message.endswith("not found.")]
+
+		if errors and not traffic:
+			return errors[0]
+
+		return traffic
+
+	async def get_uptime(self) -> Union[int, XrayError]:
+		"""
+		Get Xray uptime, it drops when the core restarts
+		:return: seconds
+		"""
+		try:
+			resp = await self.call(
+				"GetSysStats",
+				stats_command_pb2.SysStatsRequest(),
+				idempotent=True,
+			)
+			return resp.Uptime
+		except grpc.RpcError as rpc_err:
+			return XrayError(rpc_err.details())
+
+	async def get_user_emails(self) -> Union[Set[str], XrayError]:
+		"""
+		Get e-mails of users which have traffic counters in Xray
+		:return:
+		"""
+		stats = await self.query_stats("user>>>")
+
+		if type(stats) is XrayError:
+			return stats
+
+		# the pattern is a substring, so tags like "inbound>>>vless-user>>>..." match too
+		return {parsed[0] for parsed in map(parse_user_stat_name, stats) if parsed is not None}
+
 	async def add_user(
 		self,
 		inbound_tag: str,
@@ -141,7 +507,6 @@ class Xray(object):
 		:param flow:
 		:return:
 		"""
-		stub = proxyman_command_pb2_grpc.HandlerServiceStub(self.xray_client)
 		try:
 			if type == NodeTypeEnum.VMess.value:
 				user = user_pb2.User(
@@ -157,11 +522,12 @@ class Xray(object):
 				)
 			elif type == NodeTypeEnum.Shadowsocks.value:
 				try:
-					stub.AlterInbound(
+					await self.call(
+						"AlterInbound",
 						proxyman_command_pb2.AlterInboundRequest(
 							tag=inbound_tag,
 							operation=to_typed_message(proxyman_command_pb2.RemoveUserOperation(email=email)),
-						)
+						),
 					)
 				except grpc.RpcError as _:
 					pass
@@ -196,11 +562,12 @@ class Xray(object):
 			else:
 				return XrayError(f"{type} not found")
 			
-			stub.AlterInbound(
+			await self.call(
+				"AlterInbound",
 				proxyman_command_pb2.AlterInboundRequest(
 					tag=inbound_tag,
 					operation=to_typed_message(proxyman_command_pb2.AddUserOperation(user=user)),
-				)
+				),
 			)
 		except grpc.RpcError as rpc_err:
 			detail = rpc_err.details()
@@ -219,12 +586,12 @@ class Xray(object):
 		:param email:
 		:return:
 		"""
-		stub = proxyman_command_pb2_grpc.HandlerServiceStub(self.xray_client)
 		try:
-			stub.AlterInbound(
+			await self.call(
+				"AlterInbound",
 				proxyman_command_pb2.AlterInboundRequest(
 					tag=inbound_tag, operation=to_typed_message(proxyman_command_pb2.RemoveUserOperation(email=email))
-				)
+				),
 			)
 		except grpc.RpcError as rpc_err:
 			detail = rpc_err.details()
@@ -0,0 +1,167 @@
+from typing import Awaitable, Callable, Dict, List, Set, Tuple, Union
+
+import asyncio
+
+from schemas import XrayError
+from xray import Xray, parse_user_stat_name
+
+
+def parse_nodes(value: str) -> Dict[str, str]:
+    # "de1=10.0.0.1:8000,nl1=10.0.0.2:8000" -> {"de1": "10.0.0.1:8000", ...}
+    nodes = {}
+
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        name, _, target = item.partition('=')
+        nodes[name.strip()] = target.strip()
+
+    return nodes
+
+def parse_inbounds(value: str) -> Dict[str, List[str]]:
+    # "VLESS=de1|nl1,VMESS=de1" -> {"VLESS": ["de1", "nl1"], "VMESS": ["de1"]}
+    inbounds = {}
+
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        inbound_tag, _, names = item.partition('=')
+        inbounds[inbound_tag.strip()] = [name.strip() for name in names.split('|') if name.strip()]
+
+    return inbounds
+
+
+class XrayCluster(object):
+    """
+    Registry of Xray cores with the interface of a single Xray instance.
+    Mutations go to the nodes serving the user, reads are fanned out to
+    all nodes concurrently and summed.
+    """
+
+    def __init__(self, nodes: Dict[str, Xray], inbounds: Dict[str, List[str]] = None):
+        if not nodes:
+            raise ValueError('At least one Xray node is required')
+
+        self.nodes = nodes
+        self.inbounds = inbounds or {}
+
+    def get_node_names(self, inbound_tag: str, node: str = None) -> List[str]:
+        if node:
+            return [node] if node in self.nodes else []
+
+        return [name for name in self.inbounds.get(inbound_tag, self.nodes) if name in self.nodes]
+
+    def is_serving(self, name: str, inbound_tag: str, node: str = None) -> bool:
+        return name in self.get_node_names(inbound_tag, node)
+
+    async def fan_out(
+        self,
+        names: List[str],
+        call: Callable[[Xray], Awaitable[Union[int, None, XrayError]]]
+    ) -> Dict[str, Union[int, None, XrayError]]:
+        results = await asyncio.gather(*(call(self.nodes[name]) for name in names))
+        return dict(zip(names, results))
+
+    async def sum_over_nodes(self, call: Callable[[Xray], Awaitable[Union[int, XrayError]]]) -> Union[int, XrayError]:
+        results = list((await self.fan_out(list(self.nodes), call)).values())
+        values = [result for result in results if not type(result) is XrayError]
+
+        if not values:
+            return results[0]
+
+        return sum(values)
+
+    def merge_errors(self, results: Dict[str, Union[None, XrayError]]) -> Union[None, XrayError]:
+        errors = {name: result for name, result in results.items() if type(result) is XrayError}
+
+        if not errors:
+            return None
+
+        if len(results) == 1:
+            return next(iter(errors.values()))
+
+        return XrayError('; '.join(f'{name}: {error.message}' for name, error in errors.items()))
+
+    async def close(self):
+        for node in self.nodes.values():
+            await node.close()
+
+    async def get_user_online_sessions(self, email: str) -> Union[int, XrayError]:
+        return await self.sum_over_nodes(lambda node: node.get_user_online_sessions(email))
+
+    async def get_user_online_ips(self, email: str) -> Union[Dict[str, int], XrayError]:
+        # the same IP connected to several nodes is counted once
+        results = list((await self.fan_out(list(self.nodes), lambda node: node.get_user_online_ips(email))).values())
+        values = [result for result in results if not type(result) is XrayError]
+
+        if not values:
+            return results[0]
+
+        ips: Dict[str, int] = {}
+
+        for value in values:
+            for ip, last_seen in value.items():
+                ips[ip] = max(ips.get(ip, 0), last_seen)
+
+        return ips
+
+    async def get_user_upload_traffic(self, email: str, reset: bool = False) -> Union[int, XrayError]:
+        return await self.sum_over_nodes(lambda node: node.get_user_upload_traffic(email, reset))
+
+    async def get_user_download_traffic(self, email: str, reset: bool = False) -> Union[int, XrayError]:
+        return await self.sum_over_nodes(lambda node: node.get_user_download_traffic(email, reset))
+
+    async def get_inbound_upload_traffic(self, inbound_tag: str, reset: bool = False) -> Union[int, XrayError]:
+        return await self.sum_over_nodes(lambda node: node.get_inbound_upload_traffic(inbound_tag, reset))
+
+    async def get_inbound_download_traffic(self, inbound_tag: str, reset: bool = False) -> Union[int, XrayError]:
+        return await self.sum_over_nodes(lambda node: node.get_inbound_download_traffic(inbound_tag, reset))
+
+    async def get_users_traffic(self, reset: bool = False) -> Tuple[Dict[str, List[int]], Dict[str, XrayError]]:
+        """
+        Get uplink and downlink of all users with QueryStats calls per node.
+        Counters of failed nodes are not reset and come with the next call.
+        """
+        traffic: Dict[str, List[int]] = {}
+        errors: Dict[str, XrayError] = {}
+
+        for name, stats in (await self.fan_out(list(self.nodes), lambda node: node.get_users_traffic(reset))).items():
+            if type(stats) is XrayError:
+                errors[name] = stats
+                continue
+
+            for stat_name, value in stats.items():
+                parsed = parse_user_stat_name(stat_name)
+
+                if parsed is None:
+                    continue
+
+                email, direction = parsed
+                traffic.setdefault(email, [0, 0])[0 if direction == 'uplink' else 1] += value
+
+        return traffic, errors
+
+    async def get_user_emails(self, names: List[str] = None) -> Dict[str, Union[Set[str], XrayError]]:
+        return await self.fan_out(names or list(self.nodes), lambda node: node.get_user_emails())
+
+    async def add_user_to_nodes(self, inbound_tag: str, email: str, node: str = None, **kwargs) -> Dict[str, Union[None, XrayError]]:
+        # results per node, callers which have to undo a partial add need them
+        return await self.fan_out(
+            self.get_node_names(inbound_tag, node),
+            lambda xray: xray.add_user(inbound_tag=inbound_tag, email=email, **kwargs)
+        )
+
+    async def add_user(self, inbound_tag: str, email: str, node: str = None, **kwargs) -> Union[None, XrayError]:
+        results = await self.add_user_to_nodes(inbound_tag, email, node, **kwargs)
+
+        if not results:
+            return XrayError(f'no node serves {inbound_tag}')
+
+        return self.merge_errors(results)
+
+    async def remove_user(self, inbound_tag: str, email: str, node: str = None) -> Union[None, XrayError]:
+        names = self.get_node_names(inbound_tag, node)
+
+        if not names:
+            return XrayError(f'no node serves {inbound_tag}')
+
+        return self.merge_errors(await self.fan_out(
+            names,
+            lambda xray: xray.remove_user(inbound_tag, email)
+        ))
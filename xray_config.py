@@ -0,0 +1,194 @@
+from typing import Any, Awaitable, Callable, Dict, List
+
+import asyncio, copy, json, os, tempfile
+
+from loki_logger import LOGGER
+from schemas import NodeTypeEnum
+from xray_cluster import XrayCluster
+
+import models
+
+
+SHADOWSOCKS_METHODS = {
+    5: 'aes-128-gcm',
+    6: 'aes-256-gcm',
+    7: 'chacha20-poly1305',
+    8: 'xchacha20-poly1305',
+    9: 'none',
+}
+
+def render_client(user: models.User) -> Dict[str, Any]:
+    # same type mapping as Xray.add_user, but in the JSON config notation
+    level = user.level or 0
+
+    if user.type == NodeTypeEnum.VMess.value:
+        return {'id': user.uuid, 'email': user.email, 'level': level}
+
+    if user.type == NodeTypeEnum.VLess.value:
+        client = {'id': user.uuid, 'email': user.email, 'level': level}
+
+        if user.flow:
+            client['flow'] = user.flow
+
+        return client
+
+    if user.type == NodeTypeEnum.Shadowsocks.value:
+        return {
+            'password': user.password,
+            'method': SHADOWSOCKS_METHODS.get(user.cipher_type, 'none'),
+            'email': user.email,
+            'level': level
+        }
+
+    if user.type in (NodeTypeEnum.Shadowsocks_2022.value, NodeTypeEnum.Trojan.value):
+        return {'password': user.password, 'email': user.email, 'level': level}
+
+    if user.type == NodeTypeEnum.Socks.value:
+        return {'user': user.email, 'pass': user.password}
+
+    raise ValueError(f'{user.type} not found')
+
+def render_config(usersList: List[models.User], template: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    inbounds = {}
+
+    for user in sorted(usersList, key=lambda user: (user.inbound_tag, user.email)):
+        key = 'accounts' if user.type == NodeTypeEnum.Socks.value else 'clients'
+        inbound = inbounds.setdefault(user.inbound_tag, {'tag': user.inbound_tag, 'settings': {}})
+        inbound['settings'].setdefault(key, []).append(render_client(user))
+
+    if template is None:
+        return {'inbounds': list(inbounds.values())}
+
+    # Xray replaces inbounds by tag when config files are merged, so the full inbound of the template is written
+    fullInbounds = []
+
+    for inbound in template.get('inbounds', []):
+        inbound = copy.deepcopy(inbound)
+        settings = inbound.setdefault('settings', {})
+        rendered = inbounds.get(inbound.get('tag'), {'settings': {}})['settings']
+
+        for key in ('clients', 'accounts'):
+            if key in rendered or key in settings:
+                settings[key] = rendered.get(key, [])
+
+        fullInbounds.append(inbound)
+
+    return {'inbounds': fullInbounds}
+
+def read_template(path: str | None) -> Dict[str, Any] | None:
+    if not path:
+        return None
+
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def write_atomically(path: str, content: bytes) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ConfigSnapshot:
+    """
+    Keeps an Xray config fragment with the clients of every inbound in sync
+    with the users table, so a restarted core boots with all active users.
+    With a template the fragment holds its full inbounds, otherwise only
+    their tags and clients.
+    """
+
+    def __init__(
+        self,
+        path: str | None,
+        xray: XrayCluster,
+        load_users: Callable[[], Awaitable[List[models.User]]],
+        debounce_seconds: float = 1.0,
+        template_path: str | None = None
+    ) -> None:
+        # "{node}" in both paths is replaced by the node name, one file per node
+        self.path = path
+        self.template_path = template_path
+        self.xray = xray
+        self.load_users = load_users
+        self.debounce_seconds = debounce_seconds
+
+        self.contents: Dict[str, bytes] = {}
+        self.is_dirty = False
+        self.task: asyncio.Task | None = None
+
+    def schedule(self) -> None:
+        if not self.path:
+            return
+
+        self.is_dirty = True
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        # changes made during the debounce delay or the write are folded into one more write
+        while self.is_dirty:
+            await asyncio.sleep(self.debounce_seconds)
+            self.is_dirty = False
+
+            try:
+                await self.write()
+
+            except Exception as e:
+                LOGGER.error(
+                    'CONFIG SNAPSHOT ERROR',
+                    extra={
+                        'tags': {
+                            'error_type': type(e).__name__,
+                            'error_msg': str(e)
+                        }
+                    },
+                    exc_info=True,
+                )
+
+    async def write(self) -> None:
+        if not self.path:
+            return
+
+        usersList = await self.load_users()
+
+        for name in self.xray.nodes:
+            template = await asyncio.to_thread(
+                read_template,
+                self.template_path.format(node=name) if self.template_path else None
+            )
+            config = render_config([
+                user for user in usersList
+                if self.xray.is_serving(name, user.inbound_tag, user.node)
+            ], template)
+            content = json.dumps(config, indent=2, ensure_ascii=False).encode()
+            path = self.path.format(node=name)
+
+            if self.contents.get(path) == content:
+                continue
+
+            await asyncio.to_thread(write_atomically, path, content)
+            self.contents[path] = content
+
+            LOGGER.info(
+                'CONFIG SNAPSHOT',
+                extra={
+                    'tags': {
+                        'path': path,
+                        'users': sum(
+                            len(inbound['settings'].get(key, []))
+                            for inbound in config['inbounds'] for key in ('clients', 'accounts')
+                        )
+                    }
+                }
+            )